@@ -0,0 +1,146 @@
+"""bench_sand.py benchmarks the validate_request, get_token and SandClient.request hot paths
+
+Runs every scenario against a local FakeSandServer for each thread count and cache backend
+and prints ops/sec with p50 and p99 latencies.
+
+    python benchmarks/bench_sand.py
+    python benchmarks/bench_sand.py --scenarios cache_miss --threads 1,16 --latency 0.02
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from sand_python import SandService, SandClient
+from sand_python.sand_cache import LocalCache
+from sand_python.sand_shared_cache import SharedCache
+from fake_sand import FakeSandServer
+
+try:
+    from cachelib import SimpleCache, FileSystemCache
+except ImportError:
+    from werkzeug.contrib.cache import SimpleCache, FileSystemCache
+
+
+CACHES = {
+    'simple': lambda: SimpleCache(threshold=1000000),
+    'local': lambda: LocalCache(max_entries=1000000),
+    'file': lambda: FileSystemCache(tempfile.mkdtemp(prefix='sand-bench-'), threshold=1000000),
+    'shared': lambda: SharedCache(os.path.join(tempfile.mkdtemp(prefix='sand-bench-'), 'sand.cache'), slots=65536),
+}
+
+
+def new_service(server, cache):
+    return SandService(server.url, '/oauth2/token', '/warden/token/allowed', 'client', 'secret', 'target_scope', 'service_scope', cache)
+
+
+def scenario_cache_hit(server, service):
+    headers = {'Authorization': 'Bearer hot-token'}
+    service.validate_request(headers)
+    return lambda i: service.validate_request(headers)
+
+
+def scenario_cache_miss(server, service):
+    service.get_token()
+    # Every call validates a token that has not been seen before
+    return lambda i: service.validate_request({'Authorization': 'Bearer ' + uuid.uuid4().hex})
+
+
+def scenario_expiry_storm(server, service):
+    # Tokens live for one second, every thread keeps asking for the same few
+    server.token_ttl = 1
+    tokens = [{'Authorization': 'Bearer storm-%d' % n} for n in range(4)]
+    return lambda i: service.validate_request(tokens[i % len(tokens)])
+
+
+def scenario_client_request(server, service):
+    server.unauthorized_rate = 0.05
+    client = SandClient()
+    return lambda i: client.request('GET', server.url + '/service', service, max_retries=2, timeout=10.0)
+
+
+SCENARIOS = {
+    'cache_hit': scenario_cache_hit,
+    'cache_miss': scenario_cache_miss,
+    'expiry_storm': scenario_expiry_storm,
+    'client_request': scenario_client_request,
+}
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+def run(scenario, cache_name, threads, duration, args):
+    server = FakeSandServer(latency=args.latency, error_rate=args.error_rate).start()
+    try:
+        service = new_service(server, CACHES[cache_name]())
+        op = SCENARIOS[scenario](server, service)
+        latencies = []
+        errors = [0]
+        lock = threading.Lock()
+        deadline = time.time() + duration
+
+        def worker():
+            local_latencies = []
+            local_errors = 0
+            i = 0
+            while time.time() < deadline:
+                start = time.perf_counter()
+                try:
+                    op(i)
+                except Exception:
+                    local_errors += 1
+                local_latencies.append(time.perf_counter() - start)
+                i += 1
+            with lock:
+                latencies.extend(local_latencies)
+                errors[0] += local_errors
+
+        workers = [threading.Thread(target=worker) for _ in range(threads)]
+        started = time.time()
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        elapsed = time.time() - started
+        latencies.sort()
+        return {
+            'ops': len(latencies) / elapsed,
+            'p50': percentile(latencies, 0.50) * 1000.0,
+            'p99': percentile(latencies, 0.99) * 1000.0,
+            'errors': errors[0],
+            'sand_calls': server.counts['token'] + server.counts['verify'],
+        }
+    finally:
+        server.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the SAND hot paths against a local fake SAND server')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='comma separated, one of ' + ', '.join(SCENARIOS))
+    parser.add_argument('--caches', default='simple,local', help='comma separated, one of ' + ', '.join(CACHES))
+    parser.add_argument('--threads', default='1,4,16', help='comma separated thread counts')
+    parser.add_argument('--duration', type=float, default=3.0, help='seconds per run')
+    parser.add_argument('--latency', type=float, default=0.005, help='seconds the fake SAND server waits before answering')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of SAND calls answered with a 500')
+    args = parser.parse_args(argv)
+
+    print('%-15s %-7s %7s %12s %10s %10s %8s %10s' % ('scenario', 'cache', 'threads', 'ops/sec', 'p50 ms', 'p99 ms', 'errors', 'sand calls'))
+    for scenario in args.scenarios.split(','):
+        for cache_name in args.caches.split(','):
+            for threads in [int(t) for t in args.threads.split(',')]:
+                result = run(scenario, cache_name, threads, args.duration, args)
+                print('%-15s %-7s %7d %12.1f %10.3f %10.3f %8d %10d' % (scenario, cache_name, threads, result['ops'], result['p50'], result['p99'], result['errors'], result['sand_calls']))
+
+
+if __name__ == '__main__':
+    main()
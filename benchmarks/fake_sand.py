@@ -0,0 +1,110 @@
+"""fake_sand.py holds a local stand-in for the SAND server used by the benchmarks
+
+    FakeSandServer: serves /oauth2/token, /warden/token/allowed and a downstream /service
+    endpoint with configurable latency and error rates
+"""
+
+import json
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeSandServer():
+    """
+    Local SAND server
+        latency is the seconds each response is delayed
+        error_rate is the fraction of SAND calls answered with a 500
+        token_ttl is expires_in of service tokens and exp - iat of verified client tokens
+        unauthorized_rate is the fraction of /service calls answered with a 401
+    """
+
+    def __init__(self, latency=0.0, error_rate=0.0, token_ttl=3600, unauthorized_rate=0.0, port=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.token_ttl = token_ttl
+        self.unauthorized_rate = unauthorized_rate
+        self.counts = {'token': 0, 'verify': 0, 'service': 0}
+        self.__lock = threading.Lock()
+        self.__server = ThreadingHTTPServer(('127.0.0.1', port), self.__handler())
+        self.__server.daemon_threads = True
+        self.__thread = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.__server.server_address[1]
+
+    def start(self):
+        self.__thread = threading.Thread(target=self.__server.serve_forever)
+        self.__thread.daemon = True
+        self.__thread.start()
+        return self
+
+    def stop(self):
+        self.__server.shutdown()
+        self.__server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def count(self, name):
+        with self.__lock:
+            self.counts[name] += 1
+
+    def __handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if fake.latency:
+                    time.sleep(fake.latency)
+                if self.path == '/oauth2/token':
+                    fake.count('token')
+                    self.__sand_reply(200, {"access_token": "service-token", "expires_in": fake.token_ttl, "scope": "sand_scope", "token_type": "bearer"})
+                elif self.path == '/warden/token/allowed':
+                    fake.count('verify')
+                    now = datetime.utcnow()
+                    self.__sand_reply(200, {"sub": "client", "scopes": ["target_scope"], "iss": "fake-sand", "aud": "client",
+                                            "iat": now.strftime("%Y-%m-%dT%H:%M:%SZ"),
+                                            "exp": (now + timedelta(seconds=fake.token_ttl)).strftime("%Y-%m-%dT%H:%M:%SZ"),
+                                            "ext": None, "allowed": True})
+                else:
+                    self.do_GET()
+
+            def do_PUT(self):
+                self.do_POST()
+
+            def do_GET(self):
+                fake.count('service')
+                if random.random() < fake.unauthorized_rate:
+                    self.__reply(401, {"error": "unauthorized"})
+                else:
+                    self.__reply(200, {"success": "some response"})
+
+            def __sand_reply(self, status, body):
+                if random.random() < fake.error_rate:
+                    self.__reply(500, {"error": {"code": 500, "message": "fake SAND error"}, "error_description": "fake SAND error"})
+                else:
+                    self.__reply(status, body)
+
+            def __reply(self, status, body):
+                data = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        return Handler
@@ -1,17 +1,25 @@
-import sand_python
-from sand_python.sand_exceptions import SandError
-from sand_python.sand_service import SandService
+# Add the following in settings.py
+MIDDLEWARE = [
+    # ...
+    'sand_python.sand_middleware.SandDjangoMiddleware',
+]
 
-class SandMiddleware(object):
-    def __init__(self, get_response=None):
-        self.get_response = get_response
+SAND_TOKEN_SITE = 'http://sand-py-test'
+SAND_TOKEN_PATH = '/oauth2/token'
+SAND_TOKEN_VERIFY_PATH = '/warden/token/allowed'
+SAND_CLIENT_ID = 'client-id'
+SAND_CLIENT_SECRET = 'client-secret'
+SAND_TARGET_SCOPES = 'target_scope'
+SAND_SERVICE_SCOPES = 'service_scope'
+SAND_EXEMPT_PATHS = ['/health']
+# The middleware builds one SandService per process from these settings and Django's
+# default cache, or set SAND_SERVICE to a SandService of your own
 
-    def process_request(self, request):
-        sand = SandService('http://sand-py-test', sand_client_id, sand_client_secret, sand_target_scopes, sand_service_scopes, django_cache)
-        is_valid = sand.validate_request(request, {"Authorization": request.META["HTTP_AUTHORIZATION"]})['allowed']
-        if is_valid != True:
-            return JsonResponse({"Message": 'Request not permitted'}, status=401)
-        else:
-            return None
 
+# Or protect single views with different scopes
+from django.http import JsonResponse
+from sand_python.sand_middleware import django_sand_auth
 
+@django_sand_auth({'scopes': ['other_scope']})
+def resource(request):
+    return JsonResponse({'success': True})
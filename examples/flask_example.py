@@ -1,34 +1,34 @@
 # Add the following in app/extensions.py
-from app.sand.sand_service import SandService
+from sand_python.sand_service import SandService
+from sand_python.sand_middleware import init_flask, SandWSGIMiddleware
 
-def configure_sand(app):
+def configure_sand(app, wsgi_middleware=False):
     if app.config['ENV'] == 'PROD':
+        # One SandService for the whole process, not one per request
         sand_service = SandService(app.config['SAND_TOKEN_SITE'],
+                                   app.config['SAND_TOKEN_PATH'],
+                                   app.config['SAND_TOKEN_VERIFY_PATH'],
                                    app.config['SAND_CLIENT_ID'],
                                    app.config['SAND_CLIENT_SECRET'],
                                    app.config['SAND_TARGET_SCOPES'],
                                    app.config['SAND_SERVICE_SCOPES'],
                                    app.config['SAND_CACHE'])
-        app.sand_service = sand_service
+        init_flask(app, sand_service)
+        if wsgi_middleware:
+            # Authenticate every request of the app, the views then need no decorator
+            app.wsgi_app = SandWSGIMiddleware(app.wsgi_app, sand_service, exempt_paths=['/health'])
 
 
-# Add the following in app/api/auth.py
-from functools import wraps
-from app.sand.sand_service import SandService
-from app.exceptions import SandError
-from flask import jsonify, request, current_app
+# Add the following in app/api/views.py
+from flask import Blueprint, jsonify
+from sand_python.sand_middleware import flask_sand_auth
 
-def auth(f):
-    @wraps(f)
-    def sand_auth(*args, **kwargs):
-        try:
-            # Check if the token is valid and authorized to access the endpoint
-            is_valid = current_app.sand_service.validate_request(request)['allowed']
-        except SandError as e:
-            return (jsonify({'error': e.value}), 502)
+api = Blueprint('api', __name__)
+
+@api.route('/resource')
+@flask_sand_auth()
+def resource():
+    # SandError codes are mapped to responses, and nested checks within the same
+    # request reuse the first decision
+    return jsonify({'success': True})
 
-        if is_valid is not True:
-            return (jsonify({'error': 'Request not permitted'}), 401)
-        else:
-            return f(*args, **kwargs)
-    return sand_auth
@@ -1,4 +1,7 @@
 name = "sand_python"
-from .sand_exceptions import SandError
+from .sand_exceptions import SandError, SandUnavailableError
 from .sand_service import SandService
 from .sand_client import SandClient
+from .sand_transport import SandTransport
+from .sand_metrics import SandMetrics, StatsdMetrics, PrometheusMetrics
+from .sand_tracing import SandTracer, OpenTelemetryTracer
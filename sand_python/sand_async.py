@@ -0,0 +1,432 @@
+"""sand_async.py holds the asyncio counterparts of SandService and SandClient
+
+    AsyncSandService: non-blocking get_token() and validate_request()
+    AsyncSandClient: non-blocking request() with the same retry policy as SandClient
+    AsyncSandTransport: pooled aiohttp session, needs the optional aiohttp dependency
+"""
+
+import asyncio
+import inspect
+import json
+import time
+from .sand_service import SandService, _prime_lazy_imports
+from .sand_exceptions import SandError, SandUnavailableError
+from .sand_cache import LocalCache
+from .sand_retry import RetryPolicy, RequestBody
+from .sand_client import SandClient
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+async def _maybe_await(value):
+    # Cache backends may be plain (Django, werkzeug) or async, both are supported
+    if inspect.isawaitable(value):
+        return await value
+    return value
+
+
+class AsyncSandResponse():
+    """
+    Response read from aiohttp, with the attributes of a requests.Response used by this library
+    """
+
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8')
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class AsyncSandTransport():
+    """
+    Pooled, keep-alive aiohttp transport
+        limit is the total number of connections, limit_per_host the number per host
+        keepalive_timeout is how long an idle connection is kept open in seconds
+    """
+
+    def __init__(self, limit=100, limit_per_host=10, keepalive_timeout=30):
+        if aiohttp is None:
+            raise SandError('aiohttp is required for the asyncio API, install sand-python[async]')
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.__session = None
+
+    @property
+    def session(self):
+        # The session has to be created inside the running event loop
+        if self.__session is None or self.__session.closed:
+            connector = aiohttp.TCPConnector(limit=self.limit, limit_per_host=self.limit_per_host, keepalive_timeout=self.keepalive_timeout)
+            self.__session = aiohttp.ClientSession(connector=connector)
+        return self.__session
+
+    async def request(self, method, url, headers=None, data=None, auth=None, timeout=None):
+        if auth is not None:
+            auth = aiohttp.BasicAuth(*auth)
+        if isinstance(data, list):
+            data = aiohttp.FormData(data)
+        client_timeout = aiohttp.ClientTimeout(total=timeout) if timeout is not None else None
+        async with self.session.request(method, url, headers=headers, data=data, auth=auth, timeout=client_timeout) as resp:
+            content = await resp.read()
+            return AsyncSandResponse(resp.status, resp.headers, content)
+
+    async def post(self, url, **kwargs):
+        return await self.request('POST', url, **kwargs)
+
+    async def close(self):
+        if self.__session is not None:
+            await self.__session.close()
+            self.__session = None
+
+
+class AsyncSandService(SandService):
+    """
+    Sand Authentication for asyncio applications
+        Takes the arguments of SandService except cache_lock and token_refresh_ratio, and uses
+        the same cache keys, so sync and async services can share one cache. sand_cache can be a
+        plain or an async cache. transport is an AsyncSandTransport.
+        single_flight coalesces concurrent validations within the event loop only.
+        The jwt_verifier fetches its keys with a blocking request, warm_up() fetches them in a
+        thread ahead of the first token.
+        Every method of SandService that reaches the cache or SAND is a coroutine here,
+        cache_stats() and the protected helpers are shared as they are.
+    """
+
+    def __init__(self, sand_token_site, sand_token_path, sand_token_verify_path, sand_client_id, sand_client_secret, sand_target_scopes, sand_scope, sand_cache, cache_root='', transport=None,
+                 single_flight=True, local_cache_size=0, local_cache_ttl=60, jwt_verifier=None,
+                 negative_cache_ttl=0, negative_cache_size=1024, metrics=None,
+                 sand_timeout=(3.05, 10), circuit_failure_threshold=5, circuit_recovery_secs=30, grace_period_secs=0, grace_cache_size=10000,
+                 hashed_cache_keys=False, compact_cache_values=False, service_scopes=None,
+                 cache_ttl_margin_secs=0, max_cache_ttl_secs=None, detect_clock_skew=False, tracer=None):
+        if transport is None:
+            transport = AsyncSandTransport()
+        super(AsyncSandService, self).__init__(sand_token_site, sand_token_path, sand_token_verify_path, sand_client_id, sand_client_secret, sand_target_scopes, sand_scope, sand_cache,
+                                               cache_root=cache_root, transport=transport, single_flight=False, jwt_verifier=jwt_verifier,
+                                               negative_cache_ttl=negative_cache_ttl, negative_cache_size=negative_cache_size, metrics=metrics,
+                                               sand_timeout=sand_timeout, circuit_failure_threshold=circuit_failure_threshold, circuit_recovery_secs=circuit_recovery_secs,
+                                               grace_period_secs=grace_period_secs, grace_cache_size=grace_cache_size,
+                                               hashed_cache_keys=hashed_cache_keys, compact_cache_values=compact_cache_values,
+                                               service_scopes=service_scopes, cache_ttl_margin_secs=cache_ttl_margin_secs,
+                                               max_cache_ttl_secs=max_cache_ttl_secs, detect_clock_skew=detect_clock_skew, tracer=tracer)
+        self.async_single_flight = single_flight
+        self.__flights = {}
+        if local_cache_size > 0:
+            self.local_cache = LocalCache(local_cache_size, local_cache_ttl)
+
+    async def get_token(self, scope=None, target=None):
+        """
+        Requests a new service token for itself based on type of request. Either acting as a client or service
+        """
+        scope = self._resolve_service_scope(scope, target)
+        token_cache_key = self._get_my_token_cache_key(scope)
+        service_token = await self.__cache_get(token_cache_key, 'service_token')
+        if service_token is None:
+            return await self.__single_flight(token_cache_key, lambda: self.__request_token(token_cache_key, scope))
+        return service_token
+
+    async def prefetch_tokens(self):
+        """
+        Fetches the service tokens of sand_scope and of every scope in service_scopes concurrently
+        """
+        scopes = self._configured_scopes()
+        tokens = await asyncio.gather(*[self.get_token(scope) for scope in scopes], return_exceptions=True)
+        return dict(zip(scopes, tokens))
+
+    async def warm_up(self):
+        """
+        Same as SandService.warm_up, the verify host is reached with a request through the
+        AsyncSandTransport as aiohttp has no way to open a connection without one
+        """
+        _prime_lazy_imports()
+        await self.prefetch_tokens()
+        connections = {}
+        if self._verify_host_differs():
+            try:
+                await self.transport.request('HEAD', self.sand_token_verify_url, timeout=self._connect_timeout())
+                connections[self.sand_token_verify_url] = True
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                connections[self.sand_token_verify_url] = e
+        jwks = None
+        if self.jwt_verifier is not None:
+            jwks = await asyncio.get_running_loop().run_in_executor(None, self.jwt_verifier.warm_up)
+        return self._warm_up_report(await self.readiness(), connections, jwks)
+
+    async def readiness(self):
+        """
+        Same as SandService.readiness
+        """
+        tokens = {}
+        for scope in self._configured_scopes():
+            tokens[scope] = (await self.__cache_get(self._get_my_token_cache_key(scope), 'service_token')) is not None
+        return self._readiness_report(tokens)
+
+    async def is_ready(self):
+        return (await self.readiness())['ready']
+
+    async def __request_token(self, token_cache_key, scope=None):
+        sent_at = time.time()
+        with self.tracer.span('token_fetch') as span, self.metrics.timer('token_fetch') as timer:
+            sand_resp = await self.__post_to_sand(self.token_circuit, self.sand_token_url, auth=(self.sand_client_id, self.sand_client_secret), data=self._token_request_data(scope))
+            timer.tag('status', sand_resp.status_code)
+            span.set_attribute('http.status_code', sand_resp.status_code)
+            data = self._parse_token_response(sand_resp)
+        expiry_secs = self._get_token_cache_secs(data, sent_at)
+        if expiry_secs > 0:
+            await self.__cache_set(token_cache_key, data['access_token'], expiry_secs, 'service_token')
+        return data['access_token']
+
+    async def validate_request(self, request_headers, opts={}):
+        """
+        Validates incoming requests with their client_token
+        """
+        scopes = opts.get("scopes")
+        if scopes is None:
+            scopes = self.target_scopes
+        client_token = self._extract_client_token(request_headers)
+        client_token_cache_key = self._get_client_token_cache_key(client_token, scopes)
+        get_ret_data = None
+        if self.negative_cache is not None:
+            get_ret_data = self.negative_cache.get(client_token_cache_key)
+        if get_ret_data is None:
+            get_ret_data = self._decode_decision(await self.__cache_get(client_token_cache_key, 'client_token'))
+        if get_ret_data is not None:
+            return get_ret_data
+        return await self.__single_flight(client_token_cache_key, lambda: self.__validate_and_cache(client_token, scopes, opts, client_token_cache_key))
+
+    async def validate_many(self, items, max_concurrency=8):
+        """
+        Same as SandService.validate_many, identical requests share one validation
+            max_concurrency bounds the number of validations in flight
+        """
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def validate(request_headers, opts):
+            try:
+                async with semaphore:
+                    return await self.validate_request(request_headers, opts or {})
+            except SandError as e:
+                return e
+
+        return list(await asyncio.gather(*[validate(request_headers, opts) for request_headers, opts in items]))
+
+    async def __validate_and_cache(self, client_token, scopes, opts, client_token_cache_key):
+        if self.jwt_verifier is not None:
+            validation_resp = self.jwt_verifier.verify(client_token, scopes)
+            if validation_resp is not None:
+                await self.__cache_decision(client_token_cache_key, validation_resp, self.LOCAL_DENIAL_CACHE_SECS)
+                return validation_resp
+        try:
+            try:
+                service_token = await self.get_token()
+            except SandUnavailableError:
+                raise SandUnavailableError('Service not able to authenticate with SAND', 502)
+            except SandError:
+                raise SandError('Service not able to authenticate with SAND', 502)
+            with self.tracer.span('token_verify') as span, self.metrics.timer('token_verify') as timer:
+                sand_resp = await self.__post_to_sand(self.verify_circuit, self.sand_token_verify_url, headers=self._verify_request_headers(service_token), data=self._verify_request_data(client_token, scopes, opts))
+                timer.tag('status', sand_resp.status_code)
+                span.set_attribute('http.status_code', sand_resp.status_code)
+                validation_resp = self._parse_verify_response(sand_resp)
+        except SandUnavailableError:
+            # Keep serving a recently expired allowed decision while SAND is down
+            if self.grace_cache is not None:
+                stale = self.grace_cache.get(client_token_cache_key)
+                if stale is not None:
+                    return stale
+            raise
+        await self.__cache_decision(client_token_cache_key, validation_resp)
+        return validation_resp
+
+    async def __cache_decision(self, client_token_cache_key, validation_resp, denial_secs=0):
+        expiry_secs = self._cache_decision_locally(client_token_cache_key, validation_resp, denial_secs)
+        if expiry_secs is not None:
+            await self.__cache_set(client_token_cache_key, self._encode_decision(validation_resp), expiry_secs, 'client_token')
+
+    async def __post_to_sand(self, circuit, url, **kwargs):
+        if not circuit.allow():
+            raise SandUnavailableError('SAND is unavailable, circuit is open', 502)
+        timeout = sum(self.sand_timeout) if isinstance(self.sand_timeout, tuple) else self.sand_timeout
+        try:
+            sand_resp = await self.transport.post(url, timeout=timeout, **kwargs)
+        except aiohttp.ClientConnectionError:
+            # Sand is down, respond with 502 so client does not retry
+            circuit.record_failure()
+            raise SandUnavailableError('Failed to connect to SAND', 502)
+        except asyncio.TimeoutError:
+            circuit.record_failure()
+            raise SandUnavailableError('SAND did not respond in time', 502)
+        except asyncio.CancelledError:
+            # The caller went away, which says nothing about SAND; a trial cut short this way is
+            # replaced by CircuitBreaker.allow() after recovery_secs
+            raise
+        except Exception:
+            # Anything else still has to end a half open trial
+            circuit.record_failure()
+            raise
+        if sand_resp.status_code >= 500:
+            circuit.record_failure()
+        else:
+            circuit.record_success()
+            self._note_sand_date(sand_resp, time.time())
+        return sand_resp
+
+    async def clear_token_from_cache(self, scope=None, target=None):
+        scope = self._resolve_service_scope(scope, target)
+        token_cache_key = self._get_my_token_cache_key(scope)
+        if self.local_cache is not None:
+            self.local_cache.delete(token_cache_key)
+        await _maybe_await(self.cache.delete(token_cache_key))
+        return True
+
+    async def __single_flight(self, cache_key, coro_func):
+        # Concurrent tasks that missed the cache await the future of the first one
+        if not self.async_single_flight:
+            return await coro_func()
+        flight = self.__flights.get(cache_key)
+        if flight is not None:
+            return await asyncio.shield(flight)
+        flight = asyncio.ensure_future(coro_func())
+        self.__flights[cache_key] = flight
+        try:
+            return await asyncio.shield(flight)
+        finally:
+            if flight.done():
+                self.__flights.pop(cache_key, None)
+            else:
+                flight.add_done_callback(lambda f: self.__flights.pop(cache_key, None))
+
+    async def __cache_get(self, key, kind):
+        with self.tracer.span('cache_get', **{'sand.cache.kind': kind}) as span, self.metrics.timer('cache_get', kind=kind) as timer:
+            value = self.local_cache.get(key) if self.local_cache is not None else None
+            if value is None:
+                value = await _maybe_await(self.cache.get(key))
+                ttl = self._remaining_cache_ttl(value) if value is not None and self.local_cache is not None else None
+                if ttl is not None and ttl > 0:
+                    self.local_cache.set(key, value, min(ttl, self.local_cache.default_timeout))
+            timer.tag('result', 'miss' if value is None else 'hit')
+            span.set_attribute('sand.cache.hit', value is not None)
+            return value
+
+    async def __cache_set(self, key, value, timeout, kind):
+        with self.metrics.timer('cache_set', kind=kind):
+            if self.local_cache is not None and timeout is not None and timeout > 0:
+                self.local_cache.set(key, value, min(timeout, self.local_cache.default_timeout))
+            await _maybe_await(self.cache.set(key, value, timeout))
+
+
+class AsyncSandClient():
+    """
+    Sand Client for outgoing requests from asyncio applications
+        transport is an AsyncSandTransport; when not given the transport of the
+        AsyncSandService passed to request() is used
+        retry_policy is the RetryPolicy deciding what request() retries, as in SandClient
+        tracer is a SandTracer as in SandClient, the one of the AsyncSandService by default
+        request_body is streamed and rewound for a retry as in SandClient
+        scope or target picks the service token sent downstream as in SandClient
+    """
+
+    def __init__(self, transport=None, retry_policy=None, tracer=None):
+        self.transport = transport
+        self.tracer = tracer
+        self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+
+    def __build_header(self, sand_token, request_headers=None):
+        if request_headers is not None:
+            request_headers['Authorization'] = 'Bearer ' + sand_token
+        else:
+            request_headers = {
+                'Authorization': 'Bearer ' + sand_token,
+            }
+        return request_headers
+
+    async def request(self, method, request_url, sand_api, request_headers=None, request_body=None, max_retries=1, timeout=60.0, scope=None, target=None):
+        if not max_retries >= 1:
+            max_retries = 1
+        transport = self.transport if self.transport is not None else sand_api.transport
+        policy = self.retry_policy
+        tracer = self.tracer if self.tracer is not None else sand_api.tracer
+        deadline = policy.deadline(timeout)
+        is_retry = False
+        body = RequestBody(request_body)
+        resp = None
+        for i in range(0, max_retries):
+            is_last = i == (max_retries - 1)
+            try:
+                with tracer.span('client_request', **{'http.method': method, 'sand.attempt': i+1}) as span:
+                    if is_retry:
+                        await sand_api.clear_token_from_cache(scope, target)
+                    my_sand_token = await sand_api.get_token(scope, target)
+                    headers = tracer.inject(self.__build_header(my_sand_token, request_headers))
+                    resp = await transport.request(method, request_url, headers=headers, data=body.for_attempt(), timeout=policy.attempt_timeout(timeout, deadline))
+                    span.set_attribute('http.status_code', resp.status_code)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                wait = policy.backoff(i)
+                if is_last or not policy.is_idempotent(method) or not policy.has_time_for(wait, deadline):
+                    raise SandError("External Service Down", 502)
+                resp = None
+            else:
+                if resp.status_code == 401:
+                    # A new token is the fix for a 401, so retry right away with one
+                    is_retry = True
+                    wait = 0
+                elif policy.should_retry_status(method, resp.status_code):
+                    wait = policy.wait_for(i, resp)
+                else:
+                    break
+                if is_last or not policy.has_time_for(wait, deadline):
+                    break
+            if not body.is_replayable():
+                raise SandError("Request body can not be sent again for a retry, pass bytes or a seekable file", 502)
+            if wait > 0:
+                # Non-blocking sleep so other tasks keep running on the event loop
+                with tracer.span('client_retry_wait', **{'sand.retry.wait': wait}):
+                    await asyncio.sleep(wait)
+        return resp
+
+    async def request_many(self, requests_to_send, sand_api, max_concurrency=8, timeout=60.0, deadline_secs=None, max_retries=1, scope=None, target=None):
+        """
+        Sends many requests concurrently, as SandClient.request_many
+            max_concurrency bounds the number of requests in flight
+        """
+        calls = []
+        for item in requests_to_send:
+            call = dict(zip(SandClient.REQUEST_FIELDS, item)) if isinstance(item, (list, tuple)) else dict(item)
+            call.pop('stream', None)
+            if call.get('request_headers') is not None:
+                call['request_headers'] = dict(call['request_headers'])
+            call.setdefault('timeout', timeout)
+            call.setdefault('max_retries', max_retries)
+            call.setdefault('scope', scope)
+            call.setdefault('target', target)
+            calls.append(call)
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def send(call):
+            try:
+                async with semaphore:
+                    return await self.request(sand_api=sand_api, **call)
+            except (SandError, aiohttp.ClientError) as e:
+                return e
+
+        tasks = [asyncio.ensure_future(send(call)) for call in calls]
+        if not tasks:
+            return []
+        # The first task of each scope fetches the token, the others share it through single flight
+        await asyncio.wait(tasks, timeout=deadline_secs)
+        results = []
+        for task in tasks:
+            if task.done():
+                results.append(task.result())
+            else:
+                task.cancel()
+                results.append(SandError('Request did not complete before the deadline', 504))
+        return results
@@ -0,0 +1,159 @@
+"""sand_cache.py holds the in-process cache tier used in front of the configured sand_cache
+
+    LocalCache: bounded in-process LRU cache with per entry TTL
+    TieredCache: LocalCache in front of a shared cache like Django's or werkzeug's
+    cache_get_many(cache, keys): bulk get from any of the supported cache backends
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class LocalCache():
+    """
+    Bounded in-process cache with LRU eviction and per entry TTL
+        max_entries is the number of entries kept before the least recently used one is evicted
+        default_timeout is the TTL in seconds for entries set without a timeout
+    """
+
+    def __init__(self, max_entries=1024, default_timeout=60):
+        self.max_entries = max_entries
+        self.default_timeout = default_timeout
+        self.hits = 0
+        self.misses = 0
+        self.__entries = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self, key):
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at > time.time():
+                    self.__entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self.__entries[key]
+            self.misses += 1
+            return None
+
+    def get_many(self, keys):
+        result = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                result[key] = value
+        return result
+
+    def set(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = self.default_timeout
+        with self.__lock:
+            self.__entries[key] = (value, time.time() + timeout)
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.max_entries:
+                self.__entries.popitem(last=False)
+        return True
+
+    def add(self, key, value, timeout=None):
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is not None and entry[1] > time.time():
+                return False
+        return self.set(key, value, timeout)
+
+    def delete(self, key):
+        with self.__lock:
+            return self.__entries.pop(key, None) is not None
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+        return True
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.__entries), 'max_entries': self.max_entries}
+
+
+class TieredCache():
+    """
+    Two tier cache, a LocalCache in front of the shared cache passed to SandService
+        Reads are answered by the local tier and fall through to the shared tier on a miss.
+        Local TTLs are capped by both the local default timeout and the TTL given to set,
+        so an entry never outlives its copy in the shared tier.
+        ttl_of(value) returns how many more seconds a value read from the shared tier is valid,
+        or None when that is unknown; such values are not kept locally as their remaining TTL
+        in the shared tier can not be read back.
+        Anything else, like add or get_many, is passed through to the shared tier.
+    """
+
+    def __init__(self, local, remote, ttl_of=None):
+        self.local = local
+        self.remote = remote
+        self.ttl_of = ttl_of
+
+    def get(self, key):
+        value = self.local.get(key)
+        if value is not None:
+            return value
+        value = self.remote.get(key)
+        if value is not None:
+            self.__keep_local(key, value)
+        return value
+
+    def get_many(self, keys):
+        result = self.local.get_many(keys)
+        missing = [key for key in keys if key not in result]
+        if missing:
+            remote_result = cache_get_many(self.remote, missing)
+            for key, value in remote_result.items():
+                self.__keep_local(key, value)
+            result.update(remote_result)
+        return result
+
+    def __keep_local(self, key, value):
+        ttl = self.ttl_of(value) if self.ttl_of is not None else None
+        if ttl is not None and ttl > 0:
+            self.local.set(key, value, min(ttl, self.local.default_timeout))
+
+    def set(self, key, value, timeout=None):
+        if timeout is None:
+            self.local.set(key, value)
+        elif timeout > 0:
+            self.local.set(key, value, min(timeout, self.local.default_timeout))
+        else:
+            # Backends differ on what a timeout of 0 means, so do not keep it locally
+            self.local.delete(key)
+        return self.remote.set(key, value, timeout)
+
+    def delete(self, key):
+        self.local.delete(key)
+        return self.remote.delete(key)
+
+    def clear(self):
+        self.local.clear()
+        return self.remote.clear()
+
+    def __getattr__(self, name):
+        return getattr(self.remote, name)
+
+
+def cache_get_many(cache, keys):
+    """
+    Returns a dict of the keys found in cache, using the backend's bulk get when it has one
+    """
+    if isinstance(cache, (LocalCache, TieredCache)):
+        return cache.get_many(keys)
+    if hasattr(cache, 'get_dict'):
+        # werkzeug and cachelib caches, get_many there returns a list
+        result = cache.get_dict(*keys)
+    elif hasattr(cache, 'get_many'):
+        # Django caches
+        result = cache.get_many(keys)
+    else:
+        result = dict((key, cache.get(key)) for key in keys)
+    return dict((key, value) for key, value in result.items() if value is not None)
@@ -0,0 +1,58 @@
+"""sand_circuit.py holds the circuit breaker used around the SAND endpoints
+
+    CircuitBreaker: fails fast after repeated failures, lets a trial call through after a pause
+"""
+
+import threading
+import time
+
+
+class CircuitBreaker():
+    """
+    Circuit breaker for one SAND endpoint
+        After failure_threshold consecutive failures the circuit opens and allow() returns False
+        for recovery_secs. Then one trial call is let through: a success closes the circuit,
+        a failure opens it again. A trial that reports neither within recovery_secs is
+        replaced by a new one. A failure_threshold of 0 disables the breaker.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=5, recovery_secs=30):
+        self.failure_threshold = failure_threshold
+        self.recovery_secs = recovery_secs
+        self.state = self.CLOSED
+        self.failures = 0
+        self.__opened_at = 0
+        self.__lock = threading.Lock()
+
+    def allow(self):
+        if self.failure_threshold <= 0 or self.state == self.CLOSED:
+            return True
+        with self.__lock:
+            now = time.time()
+            if now - self.__opened_at >= self.recovery_secs:
+                # Only the caller that moves the circuit to half open makes the trial call,
+                # __opened_at then marks when the trial started
+                self.state = self.HALF_OPEN
+                self.__opened_at = now
+                return True
+            return False
+
+    def record_success(self):
+        if self.state == self.CLOSED and self.failures == 0:
+            return
+        with self.__lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        if self.failure_threshold <= 0:
+            return
+        with self.__lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.__opened_at = time.time()
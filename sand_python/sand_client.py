@@ -1,28 +1,87 @@
 import time
 import requests
+from concurrent.futures import ThreadPoolExecutor, wait
 from .sand_service import SandService
 from .sand_exceptions import SandError
+from .sand_retry import RetryPolicy, RequestBody
 
 class SandClient():
+    """
+    Sand Client for outgoing requests
+        transport is a SandTransport used for the outgoing requests; when not given the
+        transport of the SandService passed to request() is used so connections are pooled
+        metrics is a SandMetrics sink; when not given the one of the SandService is used
+        tracer is a SandTracer for a span per attempt and retry wait, whose trace context is
+        sent downstream; when not given the one of the SandService is used
+        retry_policy is the RetryPolicy deciding what request() retries and how long it waits,
+        max_retries passed to request() is the number of attempts
+        request_body may be bytes, a memoryview, a file object or an iterable of bytes, it is
+        streamed without being copied. Seekable bodies are rewound for a retry; a generator or
+        an unseekable file raises a SandError instead of being retried with a partial body.
+        scope or target picks the service token sent downstream, see SandService.service_scopes;
+        without them the token of sand_scope is sent.
+        With stream=True the response content is not read up front, iterate it with
+        iter_content() and close the response when done.
+        request_many() sends many requests concurrently over the same pooled connections
+        warm_up() gets the tokens and downstream connections ready before the first request
+    """
 
+    # Keys of request_many items given as tuples, in order
+    REQUEST_FIELDS = ('method', 'request_url', 'request_body', 'request_headers')
+
+    def __init__(self, transport=None, metrics=None, retry_policy=None, tracer=None):
+        self.transport = transport
+        self.metrics = metrics
+        self.tracer = tracer
+        self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
 
     def __retry(func):
-        def sand_request(self, method, request_url, sand_api, request_headers=None, request_body=None, max_retries=1, timeout=60.0):
+        def sand_request(self, method, request_url, sand_api, request_headers=None, request_body=None, max_retries=1, timeout=60.0, stream=False, scope=None, target=None):
             is_retry = False
+            body = RequestBody(request_body)
             if not max_retries >= 1:
                 max_retries = 1
+            metrics = self.metrics if self.metrics is not None else sand_api.metrics
+            tracer = self.tracer if self.tracer is not None else sand_api.tracer
+            policy = self.retry_policy
+            deadline = policy.deadline(timeout)
+            resp = None
             for i in range(0, max_retries):
+                is_last = i == (max_retries - 1)
                 try:
-                    resp = func(self, method, request_url, sand_api, request_headers, request_body, is_retry=is_retry, timeout=timeout)
+                    with tracer.span('client_request', **{'http.method': method, 'sand.attempt': i+1}) as span, metrics.timer('client_request', attempt=i+1) as timer:
+                        resp = func(self, method, request_url, sand_api, request_headers, body.for_attempt(), is_retry=is_retry, timeout=policy.attempt_timeout(timeout, deadline), stream=stream, scope=scope, target=target)
+                        timer.tag('status', resp.status_code)
+                        span.set_attribute('http.status_code', resp.status_code)
+                except (requests.ConnectionError, requests.exceptions.Timeout):
+                    wait = policy.backoff(i)
+                    if is_last or not policy.is_idempotent(method) or not policy.has_time_for(wait, deadline):
+                        raise SandError("External Service Down", 502)
+                    resp = None
+                    reason = 'connection_error'
+                else:
                     if resp.status_code == 401:
+                        # A new token is the fix for a 401, so retry right away with one
                         is_retry = True
-                        time.sleep((i+1)**2)
-                        continue
-                except (requests.ConnectionError, requests.exceptions.ReadTimeout):
-                    if i == (max_retries - 1):
-                        raise SandError("External Service Down", 502)
-                    continue
-                break
+                        wait = 0
+                        reason = 'unauthorized'
+                    elif policy.should_retry_status(method, resp.status_code):
+                        wait = policy.wait_for(i, resp)
+                        reason = 'status'
+                    else:
+                        break
+                    if is_last or not policy.has_time_for(wait, deadline):
+                        break
+                    if stream:
+                        # Give the connection back to the pool before the next attempt
+                        resp.close()
+                if not body.is_replayable():
+                    raise SandError("Request body can not be sent again for a retry, pass bytes or a seekable file", 502)
+                metrics._quiet_increment('client_retry', tags={'reason': reason})
+                if wait > 0:
+                    with tracer.span('client_retry_wait', **{'sand.retry.reason': reason, 'sand.retry.wait': wait}):
+                        time.sleep(wait)
+                    metrics._quiet_timing('client_retry_wait', wait)
             return resp
         return sand_request
 
@@ -38,10 +97,89 @@ class SandClient():
         return request_headers
 
     @__retry
-    def request(self, method, request_url, sand_api, request_headers=None, request_body=None, is_retry=False, timeout=60.0):
+    def request(self, method, request_url, sand_api, request_headers=None, request_body=None, is_retry=False, timeout=60.0, stream=False, scope=None, target=None):
         if is_retry == True:
-            sand_api.clear_token_from_cache()
-        my_sand_token = sand_api.get_token()
-        req = requests.Request(method, request_url, headers=self.__build_header(my_sand_token, request_headers), data=request_body).prepare()
-        session = requests.Session()
-        return session.send(req, timeout=timeout)
+            sand_api.clear_token_from_cache(scope, target)
+        my_sand_token = sand_api.get_token(scope, target)
+        # Runs inside the span of the attempt, which becomes the parent of the downstream spans
+        tracer = self.tracer if self.tracer is not None else sand_api.tracer
+        req = requests.Request(method, request_url, headers=tracer.inject(self.__build_header(my_sand_token, request_headers)), data=request_body).prepare()
+        transport = self.transport if self.transport is not None else sand_api.transport
+        return transport.send(req, timeout=timeout, stream=stream)
+
+    def warm_up(self, sand_api, urls=(), timeout=3.05):
+        """
+        Warms up sand_api and opens a pooled connection to each downstream url
+            Returns the readiness of sand_api with the result of each connection added,
+            ready is False when any of them failed
+        """
+        report = sand_api.warm_up()
+        transport = self.transport if self.transport is not None else sand_api.transport
+        report['connections'].update(transport.warm_up(urls, timeout))
+        report['ready'] = report['ready'] and all(result is True for result in report['connections'].values())
+        return report
+
+    def request_many(self, requests_to_send, sand_api, max_workers=8, timeout=60.0, deadline_secs=None, max_retries=1, scope=None, target=None):
+        """
+        Sends many requests concurrently and waits for all of them
+            requests_to_send is a list of (method, request_url[, request_body[, request_headers]])
+            tuples, or of dicts of request() arguments which may set their own timeout,
+            max_retries, stream, scope and target
+            timeout is the default per request, deadline_secs bounds the whole call
+            Returns a list in the order of requests_to_send with the response of each request,
+            or the SandError or requests exception it failed with instead of raising
+        """
+        calls = []
+        for item in requests_to_send:
+            call = dict(zip(self.REQUEST_FIELDS, item)) if isinstance(item, (list, tuple)) else dict(item)
+            if call.get('request_headers') is not None:
+                # The Authorization header is set on the dict, so each thread gets its own
+                call['request_headers'] = dict(call['request_headers'])
+            call.setdefault('timeout', timeout)
+            call.setdefault('max_retries', max_retries)
+            call.setdefault('scope', scope)
+            call.setdefault('target', target)
+            calls.append(call)
+        results = [None] * len(calls)
+        if not calls:
+            return results
+        deadline = time.time() + deadline_secs if deadline_secs is not None else None
+        # Fetch each service token once up front instead of in every worker on a cache miss
+        token_scopes = set()
+        for call in calls:
+            try:
+                token_scopes.add(sand_api._resolve_service_scope(call['scope'], call['target']))
+            except SandError:
+                # Each request fails with the error on its own
+                pass
+        for token_scope in token_scopes:
+            try:
+                sand_api.get_token(token_scope)
+            except SandError:
+                pass
+
+        def send(call):
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise SandError('Request not sent before the deadline', 504)
+                call['timeout'] = min(call['timeout'], remaining) if call['timeout'] is not None else remaining
+            return self.request(sand_api=sand_api, **call)
+
+        executor = ThreadPoolExecutor(max_workers=min(max_workers, len(calls)))
+        try:
+            futures = [executor.submit(send, call) for call in calls]
+            wait(futures, timeout=max(0, deadline - time.time()) if deadline is not None else None)
+            for i, future in enumerate(futures):
+                if not future.done():
+                    future.cancel()
+                    results[i] = SandError('Request did not complete before the deadline', 504)
+                    continue
+                try:
+                    results[i] = future.result()
+                except (SandError, requests.RequestException) as e:
+                    results[i] = e
+        finally:
+            # Requests still running past the deadline finish in the background
+            executor.shutdown(wait=False)
+        return results
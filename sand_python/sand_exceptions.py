@@ -13,3 +13,7 @@ class SandError(Exception):
 
     def get(self):
         return self.value
+
+# Raised when SAND can not be reached, times out, answers with a 5xx or its circuit is open
+class SandUnavailableError(SandError):
+    pass
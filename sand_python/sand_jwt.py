@@ -0,0 +1,134 @@
+"""sand_jwt.py holds the local verification of JWT client tokens signed by SAND
+
+    JwtVerifier.verify(token, scopes): verify a token in-process against the issuer's JWKS
+    Needs the optional PyJWT dependency, install sand-python[jwt]
+"""
+
+import threading
+import time
+import requests
+from datetime import datetime
+from dateutil import tz
+from .sand_exceptions import SandError
+from .sand_transport import SandTransport
+
+try:
+    import jwt
+except ImportError:
+    jwt = None
+
+
+class JwtVerifier():
+    """
+    Verifies signed JWT client tokens without calling SAND
+        jwks_url is the URL of the issuer's JSON Web Key Set
+        audience and issuer are checked against the aud and iss claims when given
+        jwks_cache_secs is how long the fetched keys are used before they are fetched again
+        min_refresh_secs limits how often an unknown kid triggers a new fetch of the keys
+        leeway is the clock skew in seconds allowed on exp, iat and nbf
+    verify() returns None for opaque tokens, unknown keys and tokens not yet valid by the local
+    clock so the caller falls back to SAND.
+    Only the signature, exp/iat, audience, issuer and scopes are checked, SAND policies on the
+    resource and action are not, so use it only where scopes are enough to authorize a request.
+    """
+
+    def __init__(self, jwks_url, audience=None, issuer=None, algorithms=('RS256', 'ES256'), leeway=5,
+                 jwks_cache_secs=3600, min_refresh_secs=60, transport=None, timeout=10.0):
+        if jwt is None:
+            raise SandError('PyJWT is required for local token verification, install sand-python[jwt]')
+        self.jwks_url = jwks_url
+        self.audience = audience
+        self.issuer = issuer
+        self.algorithms = list(algorithms)
+        self.leeway = leeway
+        self.jwks_cache_secs = jwks_cache_secs
+        self.min_refresh_secs = min_refresh_secs
+        self.transport = transport if transport is not None else SandTransport()
+        self.timeout = timeout
+        self.__keys = {}
+        self.__fetched_at = None
+        self.__lock = threading.Lock()
+
+    def verify(self, token, scopes):
+        """
+        Returns the same dict as the SAND verify endpoint, or None when the token cannot be verified locally
+        """
+        if token.count('.') != 2:
+            # Opaque token
+            return None
+        try:
+            header = jwt.get_unverified_header(token)
+        except jwt.InvalidTokenError:
+            return None
+        key = self.__get_key(header.get('kid'))
+        if key is None:
+            return None
+        options = {'verify_aud': self.audience is not None, 'require': ['exp', 'iat']}
+        try:
+            claims = jwt.decode(token, key, algorithms=self.algorithms, audience=self.audience, issuer=self.issuer, leeway=self.leeway, options=options)
+        except jwt.ImmatureSignatureError:
+            # iat or nbf ahead of the local clock, which may just be behind the issuer's
+            return None
+        except jwt.InvalidTokenError:
+            return {'allowed': False}
+        token_scopes = self.__get_scopes(claims)
+        if not all(scope in token_scopes for scope in scopes):
+            return {'allowed': False}
+        return {
+            'sub': claims.get('sub'),
+            'scopes': token_scopes,
+            'iss': claims.get('iss'),
+            'aud': claims.get('aud'),
+            'iat': self.__format_time(claims['iat']),
+            'exp': self.__format_time(claims['exp']),
+            'ext': claims.get('ext'),
+            'allowed': True,
+        }
+
+    def warm_up(self):
+        """
+        Fetches the JWKS ahead of the first token, returns whether any key is known
+        """
+        if self.__fetched_at is None:
+            self.__fetch_keys()
+        return len(self.__keys) > 0
+
+    def __get_key(self, kid):
+        if self.__fetched_at is None or time.time() - self.__fetched_at > self.jwks_cache_secs:
+            self.__fetch_keys()
+        elif kid not in self.__keys and time.time() - self.__fetched_at > self.min_refresh_secs:
+            # The issuer may have rotated its keys
+            self.__fetch_keys()
+        if kid is None and len(self.__keys) == 1:
+            return list(self.__keys.values())[0]
+        return self.__keys.get(kid)
+
+    def __fetch_keys(self):
+        started = time.time()
+        with self.__lock:
+            if self.__fetched_at is not None and self.__fetched_at >= started:
+                # Another thread fetched the keys while this one waited
+                return
+            try:
+                resp = self.transport.session.get(self.jwks_url, timeout=self.timeout)
+                if resp.status_code != 200:
+                    return
+                keys = {}
+                for jwk in jwt.PyJWKSet.from_dict(resp.json()).keys:
+                    keys[jwk.key_id] = jwk.key
+                self.__keys = keys
+            except (requests.RequestException, jwt.PyJWKSetError, ValueError):
+                # Keys stay as they were and tokens fall back to SAND
+                pass
+            finally:
+                self.__fetched_at = time.time()
+
+    def __get_scopes(self, claims):
+        scopes = claims.get('scopes', claims.get('scp', claims.get('scope', [])))
+        if isinstance(scopes, str):
+            scopes = scopes.split(' ')
+        return list(scopes)
+
+    def __format_time(self, timestamp):
+        # Same RFC 3339 format SAND uses for iat and exp
+        return datetime.fromtimestamp(timestamp, tz.tzutc()).isoformat()
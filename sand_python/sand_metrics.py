@@ -0,0 +1,184 @@
+"""sand_metrics.py holds the instrumentation hooks of SandService and SandClient
+
+    SandMetrics: no-op base class, subclass it to send metrics to any sink
+    StatsdMetrics: adapter for StatsD clients with incr() and timing()
+    PrometheusMetrics: adapter for prometheus_client, needs the optional dependency
+
+Metrics reported, all latencies in seconds:
+    token_fetch      request to the token endpoint, tags outcome and status
+    token_verify     request to the verify endpoint, tags outcome and status
+    cache_get        lookup in sand_cache, tags kind (service_token, client_token) and result (hit, miss)
+    cache_set        store in sand_cache, tag kind
+    client_request   each attempt of SandClient.request, tags outcome, status and attempt
+    client_retry     counter of SandClient.request retries, tag reason
+    client_retry_wait  time slept between SandClient.request attempts
+
+Errors of a sink are dropped where the library reports, a broken sink must not fail authentication.
+"""
+
+import threading
+import time
+
+# Tags reported with each metric, used by adapters that need the label names up front
+METRIC_TAGS = {
+    'token_fetch': ('outcome', 'status'),
+    'token_verify': ('outcome', 'status'),
+    'cache_get': ('kind', 'outcome', 'result'),
+    'cache_set': ('kind', 'outcome'),
+    'client_request': ('attempt', 'outcome', 'status'),
+    'client_retry': ('reason',),
+    'client_retry_wait': (),
+}
+
+# Collectors of PrometheusMetrics by (registry, prefix, name), a registry takes each name only once
+_PROMETHEUS_COLLECTORS = {}
+_PROMETHEUS_LOCK = threading.Lock()
+
+
+class _NullTimer():
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def tag(self, key, value):
+        pass
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer():
+    def __init__(self, metrics, name, tags):
+        self.metrics = metrics
+        self.name = name
+        self.tags = tags
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.tags.setdefault('outcome', 'error')
+        else:
+            self.tags.setdefault('outcome', 'success')
+        self.metrics._quiet_timing(self.name, time.perf_counter() - self.start, self.tags)
+        return False
+
+    def tag(self, key, value):
+        self.tags[key] = value
+
+
+class SandMetrics():
+    """
+    No-op metrics sink used by default
+        Subclasses set enabled to True and implement increment() and timing()
+    """
+
+    enabled = False
+
+    def increment(self, name, value=1, tags=None):
+        pass
+
+    def timing(self, name, seconds, tags=None):
+        pass
+
+    def timer(self, name, **tags):
+        """
+        Context manager that reports the time spent in its block as timing(name),
+        tags can be added with tag() and the outcome tag is set from whether it raised
+        """
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, name, tags)
+
+    def _quiet_increment(self, name, value=1, tags=None):
+        try:
+            self.increment(name, value, tags)
+        except Exception:
+            pass
+
+    def _quiet_timing(self, name, seconds, tags=None):
+        try:
+            self.timing(name, seconds, tags)
+        except Exception:
+            pass
+
+
+class StatsdMetrics(SandMetrics):
+    """
+    Sends metrics to a StatsD client, e.g. statsd.StatsClient
+        Tags are appended to the metric name in key order, like sand.token_verify.success.200
+    """
+
+    enabled = True
+
+    def __init__(self, client, prefix='sand'):
+        self.client = client
+        self.prefix = prefix
+
+    def __name(self, name, tags):
+        parts = [self.prefix, name]
+        if tags:
+            parts.extend(str(tags[key]) for key in sorted(tags))
+        return '.'.join(parts)
+
+    def increment(self, name, value=1, tags=None):
+        self.client.incr(self.__name(name, tags), value)
+
+    def timing(self, name, seconds, tags=None):
+        # StatsD timings are in milliseconds
+        self.client.timing(self.__name(name, tags), seconds * 1000.0)
+
+
+class PrometheusMetrics(SandMetrics):
+    """
+    Reports metrics as prometheus_client counters and histograms
+        Counters are named <prefix>_<name>_total and histograms <prefix>_<name>_seconds,
+        the tags in METRIC_TAGS become labels
+        Instances with the same registry and prefix share their collectors, the buckets of the
+        first one are used
+    """
+
+    enabled = True
+
+    def __init__(self, registry=None, prefix='sand', buckets=None):
+        import prometheus_client
+        self.prometheus_client = prometheus_client
+        self.registry = registry if registry is not None else prometheus_client.REGISTRY
+        self.prefix = prefix
+        self.buckets = buckets
+
+    def __get(self, kind, name):
+        key = (self.registry, self.prefix, name)
+        metric = _PROMETHEUS_COLLECTORS.get(key)
+        if metric is None:
+            # Registering the same name twice raises, and metrics are first used from many threads
+            # and by every SandService of the process
+            with _PROMETHEUS_LOCK:
+                metric = _PROMETHEUS_COLLECTORS.get(key)
+                if metric is None:
+                    label_names = METRIC_TAGS.get(name, ())
+                    if kind == 'counter':
+                        metric = self.prometheus_client.Counter(self.prefix + '_' + name, name, label_names, registry=self.registry)
+                    else:
+                        kwargs = {'buckets': self.buckets} if self.buckets is not None else {}
+                        metric = self.prometheus_client.Histogram(self.prefix + '_' + name + '_seconds', name, label_names, registry=self.registry, **kwargs)
+                    _PROMETHEUS_COLLECTORS[key] = metric
+        return metric
+
+    def __labeled(self, kind, name, tags):
+        metric = self.__get(kind, name)
+        label_names = METRIC_TAGS.get(name, ())
+        if label_names:
+            tags = tags or {}
+            return metric.labels(*[str(tags.get(key, '')) for key in label_names])
+        return metric
+
+    def increment(self, name, value=1, tags=None):
+        self.__labeled('counter', name, tags).inc(value)
+
+    def timing(self, name, seconds, tags=None):
+        self.__labeled('histogram', name, tags).observe(seconds)
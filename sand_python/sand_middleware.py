@@ -0,0 +1,263 @@
+"""sand_middleware.py holds ready made request authentication for web frameworks
+
+    SandWSGIMiddleware / SandASGIMiddleware: validate every request before it reaches the app
+    init_flask(app, sand_service) and flask_sand_auth(opts): Flask extension and view decorator
+    SandDjangoMiddleware and django_sand_auth(opts): Django middleware and view decorator
+    validate_request_once(sand_service, store, request_headers, opts): per request memoization
+
+All of them share one long-lived SandService per process and keep the decisions made for a
+request in that request's environ or scope, so nested or repeated checks cost one lookup.
+"""
+
+import asyncio
+import inspect
+import json
+import threading
+from functools import wraps
+from .sand_exceptions import SandError
+
+# Key of the decisions made for a request in its WSGI environ, ASGI scope or Django META
+DECISIONS_KEY = 'sand.decisions'
+
+_DENIED_MESSAGE = 'Request not permitted'
+_DENIED_BODY = json.dumps({'error': _DENIED_MESSAGE}).encode('utf-8')
+_JSON_CONTENT_TYPE = 'application/json'
+_STATUS_LINES = {
+    400: '400 Bad Request',
+    401: '401 Unauthorized',
+    403: '403 Forbidden',
+    500: '500 Internal Server Error',
+    502: '502 Bad Gateway',
+    503: '503 Service Unavailable',
+}
+
+
+def _memo_key(opts):
+    if not opts:
+        return None
+    scopes = opts.get('scopes')
+    return (tuple(scopes) if scopes is not None else None, opts.get('resource'), json.dumps(opts.get('context'), sort_keys=True))
+
+
+def _error_body(error):
+    return json.dumps({'error': error.value}).encode('utf-8')
+
+
+def _status_line(code):
+    return _STATUS_LINES.get(code) or (str(code) + ' Error')
+
+
+def validate_request_once(sand_service, store, request_headers, opts=None):
+    """
+    Validates the request once per set of opts, later calls for the same request return the
+    decision kept in store, a dict that lives as long as the request like its WSGI environ
+    """
+    decisions = store.get(DECISIONS_KEY)
+    if decisions is None:
+        decisions = store[DECISIONS_KEY] = {}
+    key = _memo_key(opts)
+    decision = decisions.get(key)
+    if decision is None:
+        try:
+            decision = sand_service.validate_request(request_headers, opts or {})
+        except SandError as e:
+            decision = e
+        decisions[key] = decision
+    if isinstance(decision, SandError):
+        raise decision
+    return decision
+
+
+async def validate_request_once_async(sand_service, store, request_headers, opts=None):
+    """
+    Same as validate_request_once for AsyncSandService, or for SandService which then runs in
+    the default executor so it does not block the event loop
+    """
+    decisions = store.get(DECISIONS_KEY)
+    if decisions is None:
+        decisions = store[DECISIONS_KEY] = {}
+    key = _memo_key(opts)
+    decision = decisions.get(key)
+    if decision is None:
+        try:
+            if inspect.iscoroutinefunction(sand_service.validate_request):
+                decision = await sand_service.validate_request(request_headers, opts or {})
+            else:
+                loop = asyncio.get_running_loop()
+                decision = await loop.run_in_executor(None, sand_service.validate_request, request_headers, opts or {})
+        except SandError as e:
+            decision = e
+        decisions[key] = decision
+    if isinstance(decision, SandError):
+        raise decision
+    return decision
+
+
+class SandWSGIMiddleware():
+    """
+    WSGI middleware that rejects requests without an allowed SAND token
+        opts are passed to validate_request, exempt_paths are served without authentication
+        The decision is kept in environ so the app can reuse it with validate_request_once
+    """
+
+    def __init__(self, app, sand_service, opts=None, exempt_paths=()):
+        self.app = app
+        self.sand_service = sand_service
+        self.opts = opts
+        self.exempt_paths = frozenset(exempt_paths)
+
+    def __call__(self, environ, start_response):
+        if environ.get('PATH_INFO') in self.exempt_paths:
+            return self.app(environ, start_response)
+        headers = {'Authorization': environ['HTTP_AUTHORIZATION']} if 'HTTP_AUTHORIZATION' in environ else {}
+        try:
+            decision = validate_request_once(self.sand_service, environ, headers, self.opts)
+        except SandError as e:
+            return self.__respond(start_response, e.code, _error_body(e))
+        if decision.get('allowed') is not True:
+            return self.__respond(start_response, 401, _DENIED_BODY)
+        return self.app(environ, start_response)
+
+    def __respond(self, start_response, code, body):
+        start_response(_status_line(code), [('Content-Type', _JSON_CONTENT_TYPE), ('Content-Length', str(len(body)))])
+        return [body]
+
+
+class SandASGIMiddleware():
+    """
+    ASGI middleware that rejects HTTP requests without an allowed SAND token
+        sand_service is preferably an AsyncSandService, a SandService runs in the default executor
+        The decision is kept in scope so the app can reuse it with validate_request_once_async
+    """
+
+    def __init__(self, app, sand_service, opts=None, exempt_paths=()):
+        self.app = app
+        self.sand_service = sand_service
+        self.opts = opts
+        self.exempt_paths = frozenset(exempt_paths)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope.get('path') in self.exempt_paths:
+            return await self.app(scope, receive, send)
+        headers = {}
+        for name, value in scope.get('headers', ()):
+            if name == b'authorization':
+                headers['Authorization'] = value.decode('latin-1')
+                break
+        try:
+            decision = await validate_request_once_async(self.sand_service, scope, headers, self.opts)
+        except SandError as e:
+            return await self.__respond(send, e.code, _error_body(e))
+        if decision.get('allowed') is not True:
+            return await self.__respond(send, 401, _DENIED_BODY)
+        return await self.app(scope, receive, send)
+
+    async def __respond(self, send, code, body):
+        await send({'type': 'http.response.start', 'status': code,
+                    'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode('latin-1'))]})
+        await send({'type': 'http.response.body', 'body': body})
+
+
+###### Flask
+def init_flask(app, sand_service):
+    """
+    Registers the process wide SandService used by flask_sand_auth
+    """
+    app.extensions['sand'] = sand_service
+    return sand_service
+
+
+def flask_sand_auth(opts=None):
+    """
+    Decorator for Flask views, use it as @flask_sand_auth() or @flask_sand_auth({'scopes': [...]})
+    """
+    def decorator(f):
+        @wraps(f)
+        def sand_auth(*args, **kwargs):
+            from flask import current_app, request, jsonify
+            try:
+                decision = validate_request_once(current_app.extensions['sand'], request.environ, request.headers, opts)
+            except SandError as e:
+                return (jsonify({'error': e.value}), e.code)
+            if decision.get('allowed') is not True:
+                return (jsonify({'error': _DENIED_MESSAGE}), 401)
+            return f(*args, **kwargs)
+        return sand_auth
+    return decorator
+
+
+###### Django
+_django_sand_service = None
+_django_lock = threading.Lock()
+
+
+def get_django_sand_service():
+    """
+    Returns the process wide SandService for Django, settings.SAND_SERVICE when it is set or
+    one built once from the SAND_* settings and the default Django cache
+    """
+    global _django_sand_service
+    if _django_sand_service is None:
+        with _django_lock:
+            if _django_sand_service is None:
+                from django.conf import settings
+                sand_service = getattr(settings, 'SAND_SERVICE', None)
+                if sand_service is None:
+                    from django.core.cache import cache
+                    from .sand_service import SandService
+                    sand_service = SandService(settings.SAND_TOKEN_SITE,
+                                               getattr(settings, 'SAND_TOKEN_PATH', '/oauth2/token'),
+                                               getattr(settings, 'SAND_TOKEN_VERIFY_PATH', '/warden/token/allowed'),
+                                               settings.SAND_CLIENT_ID,
+                                               settings.SAND_CLIENT_SECRET,
+                                               settings.SAND_TARGET_SCOPES,
+                                               settings.SAND_SERVICE_SCOPES,
+                                               cache)
+                _django_sand_service = sand_service
+    return _django_sand_service
+
+
+def _django_validate(request, opts):
+    from django.http import JsonResponse
+    headers = {'Authorization': request.META['HTTP_AUTHORIZATION']} if 'HTTP_AUTHORIZATION' in request.META else {}
+    try:
+        decision = validate_request_once(get_django_sand_service(), request.META, headers, opts)
+    except SandError as e:
+        return JsonResponse({'error': e.value}, status=e.code)
+    if decision.get('allowed') is not True:
+        return JsonResponse({'error': _DENIED_MESSAGE}, status=401)
+    return None
+
+
+class SandDjangoMiddleware():
+    """
+    Django middleware that rejects requests without an allowed SAND token,
+    settings.SAND_EXEMPT_PATHS are served without authentication
+    """
+
+    def __init__(self, get_response):
+        from django.conf import settings
+        self.get_response = get_response
+        self.exempt_paths = frozenset(getattr(settings, 'SAND_EXEMPT_PATHS', ()))
+
+    def __call__(self, request):
+        if request.path not in self.exempt_paths:
+            denied = _django_validate(request, None)
+            if denied is not None:
+                return denied
+        return self.get_response(request)
+
+
+def django_sand_auth(opts=None):
+    """
+    Decorator for Django views, use it as @django_sand_auth() or @django_sand_auth({'scopes': [...]})
+    """
+    def decorator(view):
+        @wraps(view)
+        def sand_auth(request, *args, **kwargs):
+            denied = _django_validate(request, opts)
+            if denied is not None:
+                return denied
+            return view(request, *args, **kwargs)
+        return sand_auth
+    return decorator
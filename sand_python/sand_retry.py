@@ -0,0 +1,133 @@
+"""sand_retry.py holds the retry policy of SandClient and AsyncSandClient
+
+    RetryPolicy: capped exponential backoff with full jitter, Retry-After and an overall deadline
+    RequestBody: sends a request body again on a retry without buffering it
+"""
+
+import random
+import time
+from email.utils import parsedate_tz, mktime_tz
+
+
+class RetryPolicy():
+    """
+    Decides which responses and errors of an outgoing request are retried and how long to wait
+        A 401 is retried right away with a new service token, waiting does not fix a bad token.
+        Connection errors, timeouts and retry_statuses are retried for idempotent methods only,
+        after a random wait between 0 and min(max_delay, base_delay * 2 ** attempt) or the
+        Retry-After of the response when it has one.
+        All attempts and waits share the timeout given to request() as one deadline.
+    """
+
+    IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE', 'TRACE'])
+
+    def __init__(self, base_delay=0.1, max_delay=10.0, retry_statuses=(429, 500, 502, 503, 504), respect_retry_after=True, idempotent_methods=None):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retry_statuses = frozenset(retry_statuses)
+        self.respect_retry_after = respect_retry_after
+        self.idempotent_methods = frozenset(idempotent_methods) if idempotent_methods is not None else self.IDEMPOTENT_METHODS
+
+    def is_idempotent(self, method):
+        return method.upper() in self.idempotent_methods
+
+    def should_retry_status(self, method, status_code):
+        return status_code in self.retry_statuses and self.is_idempotent(method)
+
+    def backoff(self, attempt):
+        """
+        Full jitter wait before the retry that follows attempt, attempts count from 0
+        """
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    def wait_for(self, attempt, resp=None):
+        if self.respect_retry_after and resp is not None:
+            retry_after = self.retry_after(resp)
+            if retry_after is not None:
+                return retry_after
+        return self.backoff(attempt)
+
+    def retry_after(self, resp):
+        """
+        Seconds from the Retry-After header of resp, given either as seconds or as an HTTP date
+        """
+        value = resp.headers.get('Retry-After') if getattr(resp, 'headers', None) is not None else None
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        parsed = parsedate_tz(value)
+        if parsed is None:
+            return None
+        return max(0.0, mktime_tz(parsed) - time.time())
+
+    def deadline(self, timeout):
+        if timeout is None:
+            return None
+        if isinstance(timeout, tuple):
+            # (connect, read) timeouts of requests
+            timeout = sum(t for t in timeout if t is not None)
+        return time.time() + timeout
+
+    def attempt_timeout(self, timeout, deadline):
+        """
+        Timeout for the next attempt so it does not run past the deadline
+            A (connect, read) tuple keeps connect + read within the time left
+        """
+        if deadline is None:
+            return timeout
+        remaining = deadline - time.time()
+        if isinstance(timeout, tuple):
+            connect, read = timeout
+            connect = max(0.001, min(connect if connect is not None else remaining, remaining))
+            read = max(0.001, min(read if read is not None else remaining, remaining - connect))
+            return (connect, read)
+        return max(0.001, min(timeout, remaining))
+
+    def has_time_for(self, wait, deadline):
+        return deadline is None or time.time() + wait < deadline
+
+
+class RequestBody():
+    """
+    Request body of an outgoing request that is sent again on a retry without being copied
+        bytes, bytearray, memoryview, str, dicts and lists are sent as they are on every attempt.
+        Seekable file objects are rewound to the position they had before the first attempt.
+        Other file objects, generators and iterators are streamed once, is_replayable() turns
+        False after the first attempt so the caller can fail instead of sending a partial body.
+    """
+
+    def __init__(self, body):
+        if isinstance(body, memoryview) and body.format != 'B':
+            # Byte view of the same buffer, so the length is counted in bytes
+            body = body.cast('B')
+        self.body = body
+        self.__position = None
+        self.__one_shot = False
+        self.__sent = False
+        if body is None or isinstance(body, (bytes, bytearray, memoryview, str, dict, list, tuple)):
+            return
+        if hasattr(body, 'read'):
+            try:
+                if not hasattr(body, 'seekable') or body.seekable():
+                    self.__position = body.tell()
+                    return
+            except (AttributeError, OSError, ValueError):
+                pass
+            self.__one_shot = True
+        elif hasattr(body, '__iter__') or hasattr(body, '__aiter__'):
+            self.__one_shot = True
+
+    def is_replayable(self):
+        return not (self.__one_shot and self.__sent)
+
+    def for_attempt(self):
+        """
+        Returns the body to send on the next attempt, rewinding it when it was sent before
+        """
+        if self.__sent and self.__position is not None:
+            self.body.seek(self.__position)
+        self.__sent = True
+        return self.body
@@ -1,23 +1,85 @@
 """sand_service.py holds sand authentication code both acting as client or service
 
-    get_token(): For incoming requests and outgoing, get a service token
+    get_token(scope, target): For incoming requests and outgoing, get a service token
+    prefetch_tokens(): Fetch the service tokens of all configured scopes, e.g. at startup
+    warm_up() and readiness(): Get ready to take traffic and report whether it is
     validate_request(request): Validate incoming request against sand auth allowed server, request needs to have auth token
 """
 
+import hashlib
 import json
-import re
+import threading
+import time
 import requests
-from dateutil import parser
-from .sand_exceptions import SandError
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_tz, mktime_tz
+from .sand_exceptions import SandError, SandUnavailableError
+from .sand_transport import SandTransport
+from .sand_singleflight import SingleFlight
+from .sand_cache import LocalCache, TieredCache, cache_get_many
+from .sand_metrics import SandMetrics
+from .sand_tracing import SandTracer
+from .sand_circuit import CircuitBreaker
+from .sand_time import parse_rfc3339_timestamp
+
+def _prime_lazy_imports():
+    # Both paths of the timestamp parser, dateutil builds its tables on the first parse
+    parse_rfc3339_timestamp('2016-09-06T08:32:59.71-07:00')
+    parse_rfc3339_timestamp('Tue, 06 Sep 2016 08:32:59 GMT')
+    # The codec requests imports on the first request to a host name
+    'sand'.encode('idna')
+
 
 class SandService():
     """
     Sand Authentication
         target scopes is a csv of scopes like "scope1,scope2"
         sand scope is a space delimited list of scopes like "scope1 scope2"
+        transport is a SandTransport whose pooled connections are used for all calls to SAND
+        single_flight coalesces concurrent token fetches and validations for the same cache key,
+        cache_lock extends it across processes with a lock taken through sand_cache.add
+        token_refresh_ratio renews the service token in the background once that fraction of its
+        lifetime has passed, e.g. 0.8, so get_token does not block when the token expires; the
+        refresh time is kept in sand_cache next to the token so processes sharing it refresh
+        tokens fetched by the others too
+        local_cache_size enables an in-process LRU tier of that many entries in front of sand_cache,
+        entries live there for at most local_cache_ttl seconds
+        jwt_verifier is a JwtVerifier that validates signed client tokens in-process,
+        opaque tokens and tokens signed with unknown keys are still verified by SAND
+        negative_cache_ttl keeps denied decisions in-process for that many seconds instead of
+        in sand_cache, at most negative_cache_size of them, so replayed bad tokens skip SAND
+        metrics is a SandMetrics sink for cache and SAND latencies, the default does nothing
+        tracer is a SandTracer, e.g. OpenTelemetryTracer(), recording spans for cache lookups and
+        SAND calls, the default does nothing
+        sand_timeout is the (connect, read) timeout in seconds of every call to SAND
+        circuit_failure_threshold consecutive failures of the token or verify endpoint open its
+        circuit, calls then fail fast with a 502 for circuit_recovery_secs, 0 disables it
+        grace_period_secs keeps serving allowed decisions for that long after they expired when
+        SAND is unavailable, at most grace_cache_size of them are kept in-process
+        hashed_cache_keys keys client tokens by a SHA-256 digest of (token, scopes, resource, action)
+        compact_cache_values stores only allowed, sub, scopes and exp of each decision in sand_cache
+        service_scopes maps the downstream targets this service calls to the scope of the service
+        token each one needs, like {"billing": "billing:read billing:write"}; a token is cached and
+        refreshed per scope set, get_token(target="billing") and SandClient.request pick it
+        Service tokens are cached until expires_in counted from when the request was sent, and
+        decisions until their exp by the local clock and at most for exp - iat. Both TTLs are
+        shortened by cache_ttl_margin_secs and capped at max_cache_ttl_secs.
+        detect_clock_skew measures how far the clock of SAND is ahead from the Date header of its
+        responses and applies it to exp, clock_skew holds the last measured value
     """
 
-    def __init__(self, sand_token_site, sand_token_path, sand_token_verify_path, sand_client_id, sand_client_secret, sand_target_scopes, sand_scope, sand_cache, cache_root=''):
+    # Seconds to wait before retrying a failed background refresh while the old token is still valid
+    TOKEN_REFRESH_RETRY_SECS = 5
+    # Seconds a denial of the jwt_verifier is kept in sand_cache when there is no negative cache
+    LOCAL_DENIAL_CACHE_SECS = 60
+
+    def __init__(self, sand_token_site, sand_token_path, sand_token_verify_path, sand_client_id, sand_client_secret, sand_target_scopes, sand_scope, sand_cache, cache_root='', transport=None,
+                 single_flight=True, cache_lock=False, token_refresh_ratio=None,
+                 local_cache_size=0, local_cache_ttl=60, jwt_verifier=None,
+                 negative_cache_ttl=0, negative_cache_size=1024, metrics=None,
+                 sand_timeout=(3.05, 10), circuit_failure_threshold=5, circuit_recovery_secs=30,
+                 grace_period_secs=0, grace_cache_size=10000, hashed_cache_keys=False, compact_cache_values=False,
+                 service_scopes=None, cache_ttl_margin_secs=0, max_cache_ttl_secs=None, detect_clock_skew=False, tracer=None):
         if sand_token_site is None:
             raise SandError('sand_token_site value required')
         if sand_client_id is None:
@@ -32,39 +94,221 @@ class SandService():
         self.sand_token_url = sand_token_site+sand_token_path
         self.sand_token_verify_url = sand_token_site+sand_token_verify_path
         self.sand_target_scopes = sand_target_scopes
+        # Parsed once here as validate_request needs them on every call
+        self.target_scopes = sand_target_scopes.split(',')
+        self.__target_scopes_key = '_'.join(sorted(self.target_scopes))
         # SAND expects scopes as one string with space as delimiter like "scope1 scope2"
         self.sand_scope = sand_scope
+        self.service_scopes = dict(service_scopes) if service_scopes is not None else {}
         self.sand_service_resource = 'coupa:service:'+sand_client_id
+        self.local_cache = None
         self.cache = sand_cache
+        if local_cache_size > 0:
+            self.local_cache = LocalCache(local_cache_size, local_cache_ttl)
+            self.cache = TieredCache(self.local_cache, sand_cache, self._remaining_cache_ttl)
+        self.metrics = metrics if metrics is not None else SandMetrics()
+        self.tracer = tracer if tracer is not None else SandTracer()
+        self.negative_cache = None
+        if negative_cache_ttl > 0:
+            self.negative_cache = LocalCache(negative_cache_size, negative_cache_ttl)
+        self.grace_period_secs = grace_period_secs
+        self.grace_cache = None
+        if grace_period_secs > 0:
+            self.grace_cache = LocalCache(grace_cache_size)
+        self.sand_timeout = sand_timeout
+        self.token_circuit = CircuitBreaker(circuit_failure_threshold, circuit_recovery_secs)
+        self.verify_circuit = CircuitBreaker(circuit_failure_threshold, circuit_recovery_secs)
         self.cache_root = cache_root
+        self.hashed_cache_keys = hashed_cache_keys
+        self.compact_cache_values = compact_cache_values
+        self.transport = transport if transport is not None else SandTransport()
+        self.single_flight = None
+        if single_flight:
+            self.single_flight = SingleFlight(sand_cache if cache_lock else None)
+        self.token_refresh_ratio = token_refresh_ratio
+        self.jwt_verifier = jwt_verifier
+        self.cache_ttl_margin_secs = cache_ttl_margin_secs
+        self.max_cache_ttl_secs = max_cache_ttl_secs
+        self.detect_clock_skew = detect_clock_skew
+        self.clock_skew = 0.0
+        self.__token_refresh_at = {}
+        self.__refreshing = set()
+        self.__refresh_lock = threading.Lock()
 
-    def get_token(self):
+    def get_token(self, scope=None, target=None):
         """
         Requests a new service token for itself based on type of request. Either acting as a client or service
+            scope is a space delimited string or a list of scopes, target a key of service_scopes,
+            without either the token has sand_scope
         """
         # The following is the token of the client/service that is connecting to SAND
-        token_cache_key = self.__get_my_token_cache_key(self.__get_self_sand_scope())
-        service_token = self.cache.get(token_cache_key)
+        scope = self._resolve_service_scope(scope, target)
+        token_cache_key = self._get_my_token_cache_key(scope)
+        service_token = self.__cache_get(token_cache_key, 'service_token')
         if service_token is None:
-            data = [('grant_type', 'client_credentials'), ('scope', self.__get_self_sand_scope())]
-            try:
-                sand_resp = requests.post(self.sand_token_url, auth=(self.sand_client_id, self.sand_client_secret), data=data)
-                if sand_resp.status_code != 200:
-                    # Unable to get token from SAND so responding with the whole json respone for not being a 200 OK
-                    # It's the job of the client to retry when making a request and it fails so no retries here
-                    raise SandError('Service not able to authenticate with SAND: ' + sand_resp.json()['error_description'], 401)
-                else:
-                    data = sand_resp.json()
-                    if 'access_token' not in data or data['access_token'] == "":
-                        raise SandError('Service not able to authenticate with SAND', 401)
-                    self.cache.set(token_cache_key, data['access_token'], data['expires_in'])
-                    return data['access_token']
-            except requests.ConnectionError:
-                # Sand is down, respond with 502 so client does not retry
-                raise SandError('Failed to connect to SAND', 502)
+            # Concurrent callers that missed the cache share one request to SAND
+            return self.__single_flight(token_cache_key, lambda: self.__request_token(token_cache_key, scope), check=lambda: self.cache.get(token_cache_key))
         else:
+            if self.token_refresh_ratio is not None:
+                self.__refresh_ahead(token_cache_key, scope)
             return service_token
 
+    def prefetch_tokens(self, max_workers=8):
+        """
+        Fetches the service tokens of sand_scope and of every scope in service_scopes concurrently,
+        so the first outgoing request to each target does not wait on SAND.
+        Returns a dict of scope to token, with a SandError in place of each failed fetch
+        """
+        scopes = self._configured_scopes()
+
+        def fetch(scope):
+            try:
+                return self.get_token(scope)
+            except SandError as e:
+                return e
+
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(scopes))) as executor:
+            return dict(zip(scopes, executor.map(fetch, scopes)))
+
+    def warm_up(self):
+        """
+        Gets the service ready to take traffic: primes the lazily loaded parsers, fetches the
+        service token of every configured scope, which also opens a pooled connection to SAND,
+        and the keys of the jwt_verifier.
+        Returns readiness() with the result of the verify host connection and of the JWKS fetch
+        """
+        _prime_lazy_imports()
+        self.prefetch_tokens()
+        connections = {}
+        if self._verify_host_differs():
+            connections = self.transport.warm_up([self.sand_token_verify_url], self._connect_timeout())
+        jwks = self.jwt_verifier.warm_up() if self.jwt_verifier is not None else None
+        return self._warm_up_report(self.readiness(), connections, jwks)
+
+    def readiness(self):
+        """
+        Reports whether the service can take traffic without blocking on SAND
+            ready is True when the token of every configured scope is cached and no circuit is open
+        """
+        tokens = dict((scope, self.cache.get(self._get_my_token_cache_key(scope)) is not None) for scope in self._configured_scopes())
+        return self._readiness_report(tokens)
+
+    def _configured_scopes(self):
+        scopes = [self.sand_scope]
+        for scope in self.service_scopes.values():
+            scope = self._resolve_service_scope(scope)
+            if scope not in scopes:
+                scopes.append(scope)
+        return scopes
+
+    def _readiness_report(self, tokens):
+        circuits = {'token': self.token_circuit.state, 'verify': self.verify_circuit.state}
+        ready = all(tokens.values()) and CircuitBreaker.OPEN not in circuits.values()
+        return {'ready': ready, 'tokens': tokens, 'circuits': circuits}
+
+    def _warm_up_report(self, report, connections, jwks):
+        report['connections'] = connections
+        report['ready'] = report['ready'] and all(result is True for result in connections.values())
+        if jwks is not None:
+            report['jwks'] = jwks
+            report['ready'] = report['ready'] and jwks
+        return report
+
+    def _verify_host_differs(self):
+        return self.sand_token_verify_url.split('/', 3)[:3] != self.sand_token_url.split('/', 3)[:3]
+
+    def _connect_timeout(self):
+        return self.sand_timeout[0] if isinstance(self.sand_timeout, tuple) else self.sand_timeout
+
+    def is_ready(self):
+        return self.readiness()['ready']
+
+    def _resolve_service_scope(self, scope=None, target=None):
+        if target is not None:
+            if target not in self.service_scopes:
+                raise SandError('No SAND scope configured for target ' + str(target), 500)
+            scope = self.service_scopes[target]
+        if scope is None:
+            return self._get_self_sand_scope()
+        if isinstance(scope, (list, tuple)):
+            return ' '.join(scope)
+        return scope
+
+    def __refresh_ahead(self, token_cache_key, scope):
+        now = time.time()
+        refresh_at = self.__token_refresh_at.get(token_cache_key)
+        if refresh_at is not None and now < refresh_at or token_cache_key in self.__refreshing:
+            return
+        # The token may have been fetched, or refreshed already, by another process sharing sand_cache
+        shared_refresh_at = self.cache.get(self.__refresh_at_cache_key(token_cache_key))
+        if shared_refresh_at is None:
+            if refresh_at is None:
+                # Cached without a refresh time, look again later instead of on every call
+                self.__token_refresh_at[token_cache_key] = now + self.TOKEN_REFRESH_RETRY_SECS
+                return
+        elif refresh_at is None or shared_refresh_at > refresh_at:
+            self.__token_refresh_at[token_cache_key] = refresh_at = shared_refresh_at
+        if now < refresh_at:
+            return
+        with self.__refresh_lock:
+            if token_cache_key in self.__refreshing:
+                return
+            self.__refreshing.add(token_cache_key)
+        refresher = threading.Thread(target=self.__background_refresh, args=(token_cache_key, scope, refresh_at))
+        refresher.daemon = True
+        refresher.start()
+
+    def __background_refresh(self, token_cache_key, scope, refresh_at):
+        def refreshed_elsewhere():
+            # The current token is still cached, so it is only reused once another process renewed it
+            shared_refresh_at = self.cache.get(self.__refresh_at_cache_key(token_cache_key))
+            if shared_refresh_at is not None and shared_refresh_at > refresh_at:
+                self.__token_refresh_at[token_cache_key] = shared_refresh_at
+                return self.cache.get(token_cache_key)
+            return None
+        try:
+            self.__single_flight(token_cache_key, lambda: self.__request_token(token_cache_key, scope), check=refreshed_elsewhere)
+        except Exception:
+            # The cached token is still valid, try again later whatever the error was
+            self.__token_refresh_at[token_cache_key] = time.time() + self.TOKEN_REFRESH_RETRY_SECS
+        finally:
+            with self.__refresh_lock:
+                self.__refreshing.discard(token_cache_key)
+
+    def __refresh_at_cache_key(self, token_cache_key):
+        return token_cache_key + '/refresh_at'
+
+    def __request_token(self, token_cache_key, scope=None):
+        sent_at = time.time()
+        with self.tracer.span('token_fetch') as span, self.metrics.timer('token_fetch') as timer:
+            sand_resp = self.__post_to_sand(self.token_circuit, self.sand_token_url, auth=(self.sand_client_id, self.sand_client_secret), data=self._token_request_data(scope))
+            timer.tag('status', sand_resp.status_code)
+            span.set_attribute('http.status_code', sand_resp.status_code)
+            data = self._parse_token_response(sand_resp)
+        expiry_secs = self._get_token_cache_secs(data, sent_at)
+        if expiry_secs > 0:
+            self.__cache_set(token_cache_key, data['access_token'], expiry_secs, 'service_token')
+            if self.token_refresh_ratio is not None:
+                refresh_at = time.time() + expiry_secs * self.token_refresh_ratio
+                self.__token_refresh_at[token_cache_key] = refresh_at
+                self.cache.set(self.__refresh_at_cache_key(token_cache_key), refresh_at, expiry_secs)
+        return data['access_token']
+
+    def _token_request_data(self, scope=None):
+        return [('grant_type', 'client_credentials'), ('scope', scope if scope is not None else self._get_self_sand_scope())]
+
+    def _parse_token_response(self, sand_resp):
+        if sand_resp.status_code >= 500:
+            raise SandUnavailableError('Service not able to authenticate with SAND: SAND returned ' + str(sand_resp.status_code), 502)
+        if sand_resp.status_code != 200:
+            # Unable to get token from SAND so responding with the whole json respone for not being a 200 OK
+            # It's the job of the client to retry when making a request and it fails so no retries here
+            raise SandError('Service not able to authenticate with SAND: ' + sand_resp.json()['error_description'], 401)
+        data = sand_resp.json()
+        if 'access_token' not in data or data['access_token'] == "":
+            raise SandError('Service not able to authenticate with SAND', 401)
+        return data
+
 
     # With the addition of request_headers, as Django and Flask
     # have different formats for headers, we don't need request as param
@@ -72,38 +316,213 @@ class SandService():
         """
         Validates incoming requests with their client_token
         """
-        scopes = opts.get("scopes", self.sand_target_scopes.split(','))
-        client_token = self.__extract_client_token(request_headers)
+        scopes = opts.get("scopes")
+        if scopes is None:
+            scopes = self.target_scopes
+        client_token = self._extract_client_token(request_headers)
+        client_token_cache_key = self._get_client_token_cache_key(client_token, scopes)
         # Check if the client request and token are in cache
-        get_ret_data = self.cache.get(self.__get_client_token_cache_key(client_token, scopes))
+        get_ret_data = self.__get_cached_decision(client_token_cache_key)
         # If matches with cached key, clear to load the view
         if get_ret_data is not None:
             return get_ret_data
-        # To validate with SAND, first get our own token
+        return self.__single_flight(client_token_cache_key, lambda: self.__validate_and_cache(client_token, scopes, opts, client_token_cache_key),
+                                    check=lambda: self._decode_decision(self.cache.get(client_token_cache_key)))
+
+    def validate_many(self, items, max_workers=8):
+        """
+        Validates many incoming requests in one call
+            items is a list of (request_headers, opts) pairs, opts can be None
+            Returns a list in the order of items with the validation dict of each request,
+            or the SandError it failed with instead of raising on the first failure
+        """
+        results = [None] * len(items)
+        # Identical (token, scopes) pairs are looked up and validated only once
+        pending = {}
+        for i, (request_headers, opts) in enumerate(items):
+            opts = opts or {}
+            try:
+                scopes = opts.get("scopes")
+                if scopes is None:
+                    scopes = self.target_scopes
+                client_token = self._extract_client_token(request_headers)
+            except SandError as e:
+                results[i] = e
+                continue
+            client_token_cache_key = self._get_client_token_cache_key(client_token, scopes)
+            if client_token_cache_key not in pending:
+                pending[client_token_cache_key] = (client_token, scopes, opts, [])
+            pending[client_token_cache_key][3].append(i)
+
+        cached = {}
+        if self.negative_cache is not None:
+            cached = self.negative_cache.get_many(list(pending.keys()))
+        remaining = [key for key in pending if key not in cached]
+        if remaining:
+            for client_token_cache_key, value in cache_get_many(self.cache, remaining).items():
+                cached[client_token_cache_key] = self._decode_decision(value)
+        misses = [key for key in pending if key not in cached]
+        decisions = dict(cached)
+        if misses:
+            def validate_miss(client_token_cache_key):
+                client_token, scopes, opts, _ = pending[client_token_cache_key]
+                try:
+                    return self.__single_flight(client_token_cache_key, lambda: self.__validate_and_cache(client_token, scopes, opts, client_token_cache_key),
+                                    check=lambda: self._decode_decision(self.cache.get(client_token_cache_key)))
+                except SandError as e:
+                    return e
+            with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(misses)))) as executor:
+                for client_token_cache_key, decision in zip(misses, executor.map(validate_miss, misses)):
+                    decisions[client_token_cache_key] = decision
+
+        for client_token_cache_key, (_, _, _, indexes) in pending.items():
+            for i in indexes:
+                results[i] = decisions[client_token_cache_key]
+        return results
+
+    def __validate_and_cache(self, client_token, scopes, opts, client_token_cache_key):
+        if self.jwt_verifier is not None:
+            validation_resp = self.jwt_verifier.verify(client_token, scopes)
+            if validation_resp is not None:
+                self.__cache_decision(client_token_cache_key, validation_resp, self.LOCAL_DENIAL_CACHE_SECS)
+                return validation_resp
         try:
-            service_token = self.get_token()
-        except SandError:
-            raise SandError('Service not able to authenticate with SAND', 502)
-        # Validate the new client token with SAND
-        validation_resp = self.__validate_with_sand(client_token, service_token, scopes, opts)
-        self.cache.set(self.__get_client_token_cache_key(client_token, scopes), validation_resp, self.__get_cache_expiry_secs(validation_resp))
+            # To validate with SAND, first get our own token
+            try:
+                service_token = self.get_token()
+            except SandUnavailableError:
+                raise SandUnavailableError('Service not able to authenticate with SAND', 502)
+            except SandError:
+                raise SandError('Service not able to authenticate with SAND', 502)
+            # Validate the new client token with SAND
+            validation_resp = self.__validate_with_sand(client_token, service_token, scopes, opts)
+        except SandUnavailableError:
+            # Keep serving a recently expired allowed decision while SAND is down
+            if self.grace_cache is not None:
+                stale = self.grace_cache.get(client_token_cache_key)
+                if stale is not None:
+                    return stale
+            raise
+        self.__cache_decision(client_token_cache_key, validation_resp)
         return validation_resp
 
+    def __get_cached_decision(self, client_token_cache_key):
+        if self.negative_cache is not None:
+            denied = self.negative_cache.get(client_token_cache_key)
+            if denied is not None:
+                return denied
+        return self._decode_decision(self.__cache_get(client_token_cache_key, 'client_token'))
 
-    def __extract_client_token(self, request_headers):
+    def __cache_decision(self, client_token_cache_key, validation_resp, denial_secs=0):
+        expiry_secs = self._cache_decision_locally(client_token_cache_key, validation_resp, denial_secs)
+        if expiry_secs is not None:
+            self.__cache_set(client_token_cache_key, self._encode_decision(validation_resp), expiry_secs, 'client_token')
+
+    def _cache_decision_locally(self, client_token_cache_key, validation_resp, denial_secs=0):
+        """
+        Keeps a decision in the in-process negative and grace caches
+            Returns the timeout to store it in sand_cache with, or None when it is not stored there
+        """
+        if validation_resp.get('allowed') is not True:
+            if self.negative_cache is not None:
+                # Denials are kept briefly in their own bounded cache so they can not crowd out allowed tokens
+                self.negative_cache.set(client_token_cache_key, validation_resp)
+                return None
+            # A local denial may come from this host's view of the token, it must not be kept forever
+            return denial_secs
+        expiry_secs = self._get_cache_expiry_secs(validation_resp)
+        if self.grace_cache is not None:
+            self.grace_cache.set(client_token_cache_key, validation_resp, expiry_secs + self.grace_period_secs)
+        # An allowed decision already expired by the local clock is not cached, a timeout of 0 would keep it forever
+        return expiry_secs if expiry_secs > 0 else None
+
+    def _remaining_cache_ttl(self, value):
+        # Decisions carry their exp, service tokens read back from sand_cache do not
+        decision = self._decode_decision(value)
+        if not isinstance(decision, dict) or not decision.get('exp'):
+            return None
         try:
-            if request_headers['Authorization'].lower().startswith('bearer'):
-                pattern = re.compile('Bearer *', re.IGNORECASE)
-                token = pattern.sub('', request_headers['Authorization'])
-                if token == "":
-                    raise SandError('Failed to extract token from the request', 401)
-                return token
-            raise SandError('Did not find any authentication token', 401)
+            return parse_rfc3339_timestamp(decision['exp']) - time.time() - self.clock_skew
+        except (ValueError, TypeError, OverflowError):
+            return None
+
+    def _encode_decision(self, validation_resp):
+        if not self.compact_cache_values:
+            return validation_resp
+        # Only the fields callers use, as a tuple which pickles far smaller than the dict
+        return (validation_resp.get('allowed'), validation_resp.get('sub'), validation_resp.get('scopes'), validation_resp.get('exp'))
+
+    def _decode_decision(self, value):
+        # Backends that serialize with JSON or msgpack give the tuple back as a list
+        if isinstance(value, (tuple, list)) and len(value) == 4:
+            allowed, sub, scopes, exp = value
+            return {'allowed': allowed, 'sub': sub, 'scopes': scopes, 'exp': exp}
+        return value
+
+    def __cache_get(self, cache_key, kind):
+        with self.tracer.span('cache_get', **{'sand.cache.kind': kind}) as span, self.metrics.timer('cache_get', kind=kind) as timer:
+            value = self.cache.get(cache_key)
+            timer.tag('result', 'miss' if value is None else 'hit')
+            span.set_attribute('sand.cache.hit', value is not None)
+            return value
+
+    def __cache_set(self, cache_key, value, timeout, kind):
+        with self.metrics.timer('cache_set', kind=kind):
+            self.cache.set(cache_key, value, timeout)
+
+    def __single_flight(self, cache_key, func, check=None):
+        # check reads a result stored meanwhile by another thread or process, the background
+        # refresh passes none because the token it replaces is still cached
+        if self.single_flight is None:
+            return func()
+        return self.single_flight.do(cache_key, func, check=check)
+
+
+    def _extract_client_token(self, request_headers):
+        try:
+            authorization = request_headers['Authorization']
         except KeyError:
             raise SandError('Did not find any authentication token', 401)
+        # Plain slicing instead of a case-insensitive regex, this runs on every request
+        if authorization[:6].lower() != 'bearer':
+            raise SandError('Did not find any authentication token', 401)
+        token = authorization[6:].lstrip(' ')
+        if token == "":
+            raise SandError('Failed to extract token from the request', 401)
+        return token
 
 
     def __validate_with_sand(self, client_token, service_token, scopes, opts={}):
+        with self.tracer.span('token_verify') as span, self.metrics.timer('token_verify') as timer:
+            sand_resp = self.__post_to_sand(self.verify_circuit, self.sand_token_verify_url, headers=self._verify_request_headers(service_token), data=self._verify_request_data(client_token, scopes, opts))
+            timer.tag('status', sand_resp.status_code)
+            span.set_attribute('http.status_code', sand_resp.status_code)
+            return self._parse_verify_response(sand_resp)
+
+    def __post_to_sand(self, circuit, url, **kwargs):
+        if not circuit.allow():
+            raise SandUnavailableError('SAND is unavailable, circuit is open', 502)
+        try:
+            sand_resp = self.transport.post(url, timeout=self.sand_timeout, **kwargs)
+        except requests.ConnectionError:
+            # Sand is down, respond with 502 so client does not retry
+            circuit.record_failure()
+            raise SandUnavailableError('Failed to connect to SAND', 502)
+        except requests.Timeout:
+            circuit.record_failure()
+            raise SandUnavailableError('SAND did not respond in time', 502)
+        except Exception:
+            # Anything else, like a broken chunked response, still has to end a half open trial
+            circuit.record_failure()
+            raise
+        if sand_resp.status_code >= 500:
+            circuit.record_failure()
+        else:
+            circuit.record_success()
+            self._note_sand_date(sand_resp, time.time())
+        return sand_resp
+
+    def _verify_request_data(self, client_token, scopes, opts={}):
         data = {
             "action": "any",
             "context": opts.get("context", {}),
@@ -111,46 +530,90 @@ class SandService():
             "resource": opts.get("resource", self.sand_service_resource),
             "scopes": scopes
         }
-        headers = {
+        return json.dumps(data)
+
+    def _verify_request_headers(self, service_token):
+        return {
             'Authorization': 'Bearer ' + service_token,
         }
-        try:
-            sand_resp = requests.post(self.sand_token_verify_url, headers=headers, data=json.dumps(data))
-            if sand_resp.status_code != 200:
-                # Unable to authenticate against sand
-                raise SandError('SAND server returned an error: ' + sand_resp.json()['error']['message'], 502)
-            else:
-                ret_data = sand_resp.json()
-                return ret_data
-        except requests.ConnectionError:
-            # Sand is down, respond with 502 so client does not retry
-            raise SandError('Failed to connect to SAND', 502)
+
+    def _parse_verify_response(self, sand_resp):
+        if sand_resp.status_code >= 500:
+            # A proxy in front of SAND answers with an HTML page, so the body is not read
+            raise SandUnavailableError('SAND server returned an error: SAND returned ' + str(sand_resp.status_code), 502)
+        if sand_resp.status_code != 200:
+            # Unable to authenticate against sand
+            try:
+                message = sand_resp.json()['error']['message']
+            except (ValueError, KeyError, TypeError):
+                message = 'SAND returned ' + str(sand_resp.status_code)
+            raise SandError('SAND server returned an error: ' + message, 502)
+        return sand_resp.json()
 
 
-    def __get_cache_expiry_secs(self, data):
-        # Use a parser to auto parse date and time coming in
+    def _get_cache_expiry_secs(self, data, received_at=None):
         # SAND expiry date time is of format "2016-09-06T08:32:59.71-07:00"
         if data['allowed'] is True:
-            exp_time = int((parser.parse(data['exp']) - parser.parse(data['iat'])).total_seconds())
-            return exp_time
+            exp = parse_rfc3339_timestamp(data['exp'])
+            now = (received_at if received_at is not None else time.time()) + self.clock_skew
+            # exp - iat alone would keep a token seen late in its life, or across a skew, past exp
+            return self._cap_cache_ttl(min(exp - parse_rfc3339_timestamp(data['iat']), exp - now))
         return 0
 
+    def _get_token_cache_secs(self, data, sent_at):
+        # expires_in counts from when SAND issued the token, which is after the request was sent
+        return self._cap_cache_ttl(data['expires_in'] - (time.time() - sent_at))
+
+    def _cap_cache_ttl(self, ttl):
+        ttl -= self.cache_ttl_margin_secs
+        if self.max_cache_ttl_secs is not None:
+            ttl = min(ttl, self.max_cache_ttl_secs)
+        # Whole seconds as memcached expects, rounded as SAND reports expires_in in whole seconds
+        return max(0, int(round(ttl)))
+
+    def _note_sand_date(self, sand_resp, received_at):
+        if not self.detect_clock_skew:
+            return
+        headers = getattr(sand_resp, 'headers', None)
+        value = headers.get('Date') if headers is not None else None
+        parsed = parsedate_tz(value) if value else None
+        if parsed is None:
+            return
+        skew = mktime_tz(parsed) - received_at
+        # Date has a resolution of one second, smaller differences are noise
+        self.clock_skew = skew if abs(skew) > 1 else 0.0
+
 
-    def __get_client_token_cache_key(self, token, scopes):
-        return self.__get_token_cache_key(token, '_'.join(sorted(scopes)), self.sand_service_resource, 'client_tokens')
+    def _get_client_token_cache_key(self, token, scopes):
+        scopes_key = self.__target_scopes_key if scopes is self.target_scopes else '_'.join(sorted(scopes))
+        if self.hashed_cache_keys:
+            # Fixed length key that keeps the bearer token out of the cache key space
+            digest = hashlib.sha256('\0'.join([token, scopes_key, self.sand_service_resource, 'client_tokens']).encode('utf-8')).hexdigest()
+            return self.cache_root + '/client_tokens/' + digest
+        return self.__get_token_cache_key(token, scopes_key, self.sand_service_resource, 'client_tokens')
+
+    def cache_stats(self):
+        """
+        Returns hit and miss counters of the in-process cache tier, or None when it is disabled
+        """
+        if self.local_cache is None:
+            return None
+        return self.local_cache.stats()
 
     # Clears token of code using this lib
-    def clear_token_from_cache(self, scope=None):
-        if scope is None:
-            scope = self.__get_self_sand_scope()
-        self.cache.delete(self.__get_my_token_cache_key(scope))
+    def clear_token_from_cache(self, scope=None, target=None):
+        scope = self._resolve_service_scope(scope, target)
+        token_cache_key = self._get_my_token_cache_key(scope)
+        self.cache.delete(token_cache_key)
+        self.cache.delete(self.__refresh_at_cache_key(token_cache_key))
+        self.__token_refresh_at.pop(token_cache_key, None)
         return True
 
-    def __get_my_token_cache_key(self, scope):
+    def _get_my_token_cache_key(self, scope):
         # Service's own SAND token does not depend on resource or action
         return self.__get_token_cache_key('SERVICE_TOKEN', '_'.join(sorted(scope.split(" "))))
 
-    def __get_self_sand_scope(self):
+    def _get_self_sand_scope(self):
         return self.sand_scope
 
     # cache_type is the sub-dir under root to separate service tokens and client tokens
@@ -0,0 +1,260 @@
+"""sand_shared_cache.py holds a cache shared by all the processes of a host
+
+    SharedCache: fixed size hash table in a memory-mapped file with per entry TTL
+"""
+
+import fcntl
+import hashlib
+import json
+import mmap
+import os
+import stat
+import struct
+import tempfile
+import threading
+import time
+from .sand_exceptions import SandError
+
+_MAGIC = b'SANDSHM2'
+# magic, slots, slot_size
+_FILE_HEADER = struct.Struct('<8sII')
+# version, expires_at, key_len, value_len
+_SLOT_HEADER = struct.Struct('<QdHI')
+_VERSION = struct.Struct('<Q')
+# Times a reader retries a slot that is being written before it counts as a miss
+_READ_RETRIES = 10
+
+
+def _default_path():
+    directory = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.path.join(directory, 'sand-python-' + str(os.getuid()) + '.cache')
+
+
+def _to_json(value):
+    # JSON has no tuples, the compact decisions are kept apart from lists by tagging them
+    if isinstance(value, tuple):
+        return {'__tuple__': [_to_json(item) for item in value]}
+    if isinstance(value, list):
+        return [_to_json(item) for item in value]
+    if isinstance(value, dict):
+        return {key: _to_json(item) for key, item in value.items()}
+    return value
+
+
+def _from_json(value):
+    if isinstance(value, dict):
+        if len(value) == 1 and '__tuple__' in value:
+            return tuple(_from_json(item) for item in value['__tuple__'])
+        return {key: _from_json(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_from_json(item) for item in value]
+    return value
+
+
+def _encode(value):
+    return json.dumps(_to_json(value), separators=(',', ':')).encode('utf-8')
+
+
+def _decode(data):
+    return _from_json(json.loads(data.decode('utf-8')))
+
+
+class SharedCache():
+    """
+    Host-local cache shared by pre-fork workers through a memory-mapped file
+        path is the file shared by the processes, by default one per user in /dev/shm
+        slots is the number of entries the file holds, slot_size the bytes of each one including
+        the key and the value; entries that do not fit are not cached
+        Values are stored as JSON, so they are made of dicts, lists, tuples, strings, numbers,
+        booleans and None; other values raise a TypeError. Another user able to write the file
+        can change the cached values but can not run code through them.
+        The file is refused unless it is a regular file owned by the current user that no one
+        else can read or write, and a symlink at path is not followed.
+        default_timeout is the TTL in seconds for entries set without a timeout, 0 never expires
+        Reads take no lock: each slot has a version that writers make odd while they write it,
+        readers retry when it was odd or changed under them. Writers take an flock on the file.
+        A key is kept in one of probe_slots slots after its hash, an expired or the soonest
+        expiring one is replaced when all of them are in use.
+    """
+
+    def __init__(self, path=None, slots=4096, slot_size=1024, default_timeout=300, probe_slots=8):
+        self.path = path if path is not None else _default_path()
+        self.slots = slots
+        self.slot_size = slot_size
+        self.default_timeout = default_timeout
+        self.probe_slots = min(probe_slots, slots)
+        self.__size = _FILE_HEADER.size + slots * slot_size
+        self.__lock = threading.Lock()
+        self.__lock_fd = None
+        self.__lock_pid = None
+        fd = self.__open(os.O_CREAT)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                self.__init_file(fd)
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            # MAP_SHARED, so workers forked after this still see each other's writes
+            self.__map = mmap.mmap(fd, self.__size)
+        finally:
+            os.close(fd)
+
+    def __open(self, flags=0):
+        fd = os.open(self.path, os.O_RDWR | os.O_NOFOLLOW | os.O_CLOEXEC | flags, 0o600)
+        try:
+            st = os.fstat(fd)
+            if not stat.S_ISREG(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+                raise SandError('Shared cache file ' + self.path + ' must be a regular file owned by the current user with mode 0600', 500)
+        except BaseException:
+            os.close(fd)
+            raise
+        return fd
+
+    def __init_file(self, fd):
+        file_size = os.fstat(fd).st_size
+        if file_size == 0:
+            os.ftruncate(fd, self.__size)
+            os.pwrite(fd, _FILE_HEADER.pack(_MAGIC, self.slots, self.slot_size), 0)
+            return
+        header = os.pread(fd, _FILE_HEADER.size, 0)
+        if file_size != self.__size or header != _FILE_HEADER.pack(_MAGIC, self.slots, self.slot_size):
+            raise SandError('Shared cache file ' + self.path + ' was created with a different format, number of slots or slot size', 500)
+
+    def __lock_file(self):
+        # flock is held per open file, which forked workers would share, so each process opens its own
+        pid = os.getpid()
+        if self.__lock_pid != pid:
+            self.__lock_fd = self.__open()
+            self.__lock_pid = pid
+        fcntl.flock(self.__lock_fd, fcntl.LOCK_EX)
+        return self.__lock_fd
+
+    def __offsets(self, key):
+        start = int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'little') % self.slots
+        for i in range(self.probe_slots):
+            yield _FILE_HEADER.size + ((start + i) % self.slots) * self.slot_size
+
+    def __read(self, offset):
+        """
+        Consistent (expires_at, key, value bytes) of a slot, or None when it is empty
+        """
+        mem = self.__map
+        for _ in range(_READ_RETRIES):
+            version, expires_at, key_len, value_len = _SLOT_HEADER.unpack_from(mem, offset)
+            if version & 1:
+                continue
+            if key_len == 0:
+                return None
+            start = offset + _SLOT_HEADER.size
+            key = mem[start:start + key_len]
+            value = mem[start + key_len:start + key_len + value_len]
+            if _VERSION.unpack_from(mem, offset)[0] == version:
+                return expires_at, key, value
+        return None
+
+    def __find(self, key):
+        for offset in self.__offsets(key):
+            entry = self.__read(offset)
+            if entry is not None and entry[1] == key:
+                return offset, entry
+        return None, None
+
+    def get(self, key):
+        offset, entry = self.__find(key.encode('utf-8'))
+        if entry is None or (entry[0] and entry[0] <= time.time()):
+            return None
+        try:
+            return _decode(entry[2])
+        except ValueError:
+            # Not written by this class, count it as a miss
+            return None
+
+    def get_many(self, keys):
+        result = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                result[key] = value
+        return result
+
+    def set(self, key, value, timeout=None):
+        return self.__write(key.encode('utf-8'), value, timeout, overwrite=True)
+
+    def add(self, key, value, timeout=None):
+        return self.__write(key.encode('utf-8'), value, timeout, overwrite=False)
+
+    def __write(self, key, value, timeout, overwrite):
+        if timeout is None:
+            timeout = self.default_timeout
+        data = _encode(value)
+        if _SLOT_HEADER.size + len(key) + len(data) > self.slot_size:
+            return False
+        now = time.time()
+        expires_at = now + timeout if timeout > 0 else 0
+        with self.__lock:
+            fd = self.__lock_file()
+            try:
+                target = None
+                free = None
+                oldest = None
+                oldest_expires = None
+                for offset in self.__offsets(key):
+                    entry = self.__read(offset)
+                    if entry is not None and entry[1] == key:
+                        if not overwrite and (entry[0] == 0 or entry[0] > now):
+                            return False
+                        target = offset
+                        break
+                    if entry is None or (entry[0] and entry[0] <= now):
+                        if free is None:
+                            free = offset
+                    elif oldest is None or (entry[0] or float('inf')) < oldest_expires:
+                        oldest, oldest_expires = offset, entry[0] or float('inf')
+                if target is None:
+                    target = free if free is not None else oldest
+                self.__write_slot(target, expires_at, key, data)
+                return True
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+
+    def __write_slot(self, offset, expires_at, key, data):
+        mem = self.__map
+        # Odd while the slot is written, a writer that died halfway leaves it odd
+        version = _VERSION.unpack_from(mem, offset)[0] | 1
+        _VERSION.pack_into(mem, offset, version)
+        start = offset + _SLOT_HEADER.size
+        mem[start:start + len(key)] = key
+        mem[start + len(key):start + len(key) + len(data)] = data
+        _SLOT_HEADER.pack_into(mem, offset, version, expires_at, len(key), len(data))
+        _VERSION.pack_into(mem, offset, version + 1)
+
+    def delete(self, key):
+        key = key.encode('utf-8')
+        with self.__lock:
+            fd = self.__lock_file()
+            try:
+                offset, entry = self.__find(key)
+                if entry is None:
+                    return False
+                self.__write_slot(offset, 0, b'', b'')
+                return True
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+
+    def clear(self):
+        with self.__lock:
+            fd = self.__lock_file()
+            try:
+                for i in range(self.slots):
+                    offset = _FILE_HEADER.size + i * self.slot_size
+                    if _SLOT_HEADER.unpack_from(self.__map, offset)[2]:
+                        self.__write_slot(offset, 0, b'', b'')
+                return True
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+
+    def close(self):
+        self.__map.close()
+        if self.__lock_fd is not None and self.__lock_pid == os.getpid():
+            os.close(self.__lock_fd)
+            self.__lock_fd = None
@@ -0,0 +1,86 @@
+"""sand_singleflight.py holds the coalescing of concurrent calls for the same cache key
+
+    SingleFlight.do(key, func): run func once for all concurrent callers of key
+"""
+
+import threading
+import time
+import uuid
+
+
+class _Call():
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight():
+    """
+    Coalesces concurrent calls that share a key so only one of them does the work
+        Within a process, followers wait for the leader thread and share its result or error.
+        When cache is given, the leader also takes a lock in the cache backend with cache.add
+        so leaders in other processes wait for it and read the result from the cache instead.
+    """
+
+    def __init__(self, cache=None, lock_timeout=10, poll_interval=0.05):
+        self.cache = cache
+        self.lock_timeout = lock_timeout
+        self.poll_interval = poll_interval
+        self.__calls = {}
+        self.__lock = threading.Lock()
+
+    def do(self, key, func, check=None):
+        """
+        Runs func for key unless another caller is already running it, in which case its result is returned
+            check is an optional function that reads the result from the cache, it is called
+            before func so a result stored by another thread or process is reused
+        """
+        with self.__lock:
+            call = self.__calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = _Call()
+                self.__calls[key] = call
+        if not is_leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = self.__run(key, func, check)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.__lock:
+                del self.__calls[key]
+            call.done.set()
+
+    def __run(self, key, func, check):
+        if check is not None:
+            result = check()
+            if result is not None:
+                return result
+        if self.cache is None or not hasattr(self.cache, 'add'):
+            return func()
+
+        lock_key = key + '/lock'
+        lock_id = uuid.uuid4().hex
+        deadline = time.time() + self.lock_timeout
+        while not self.cache.add(lock_key, lock_id, self.lock_timeout):
+            # Another process holds the lock, wait for it to store the result
+            if time.time() >= deadline:
+                return func()
+            time.sleep(self.poll_interval)
+            if check is not None:
+                result = check()
+                if result is not None:
+                    return result
+        try:
+            return func()
+        finally:
+            if self.cache.get(lock_key) == lock_id:
+                self.cache.delete(lock_key)
@@ -0,0 +1,48 @@
+"""sand_time.py holds the date and time helpers used on the validation path
+
+    parse_rfc3339_timestamp(value): seconds since the epoch of an RFC 3339 date time from SAND
+"""
+
+import calendar
+from datetime import date
+from dateutil import parser, tz
+
+_EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+
+def parse_rfc3339_timestamp(value):
+    """
+    Parses the fixed format SAND uses, like "2016-09-06T08:32:59.71-07:00" or
+    "2016-09-06T15:32:59.974664101Z", without going through dateutil.
+    Anything else is left to dateutil's parser, naive values are taken as UTC.
+    """
+    try:
+        if value[4] != '-' or value[7] != '-' or value[10] not in 'Tt ' or value[13] != ':' or value[16] != ':':
+            return _parse_with_dateutil(value)
+        if value[-1] == 'Z' or value[-1] == 'z':
+            offset_seconds = 0
+            end = len(value) - 1
+        elif value[-6] in '+-' and value[-3] == ':':
+            offset_seconds = int(value[-5:-3]) * 3600 + int(value[-2:]) * 60
+            if value[-6] == '+':
+                offset_seconds = -offset_seconds
+            end = len(value) - 6
+        else:
+            return _parse_with_dateutil(value)
+        days = date(int(value[0:4]), int(value[5:7]), int(value[8:10])).toordinal() - _EPOCH_ORDINAL
+        seconds = days * 86400 + int(value[11:13]) * 3600 + int(value[14:16]) * 60 + int(value[17:19]) + offset_seconds
+        if end > 19:
+            if value[19] != '.':
+                return _parse_with_dateutil(value)
+            # Only microseconds are kept, SAND sends up to nanoseconds
+            seconds += int((value[20:end] + '000000')[:6]) / 1000000.0
+        return seconds
+    except (ValueError, IndexError, TypeError):
+        return _parse_with_dateutil(value)
+
+
+def _parse_with_dateutil(value):
+    parsed = parser.parse(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=tz.tzutc())
+    return calendar.timegm(parsed.utctimetuple()) + parsed.microsecond / 1000000.0
@@ -0,0 +1,76 @@
+"""sand_tracing.py holds the tracing hooks of SandService and SandClient
+
+    SandTracer: no-op base class used by default, its spans do nothing
+    OpenTelemetryTracer: spans through the OpenTelemetry API, needs the optional dependency
+
+Spans recorded, named sand.<name>:
+    cache_get          lookup in sand_cache, attributes sand.cache.kind and sand.cache.hit
+    token_fetch        request to the token endpoint, attribute http.status_code
+    token_verify       request to the verify endpoint, attribute http.status_code
+    client_request     each attempt of SandClient.request, attributes http.method, sand.attempt
+                       and http.status_code; its trace context is sent downstream
+    client_retry_wait  wait between SandClient.request attempts, attributes sand.retry.reason
+                       and sand.retry.wait
+"""
+
+
+class _NullSpan():
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def set_attribute(self, key, value):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class SandTracer():
+    """
+    No-op tracer used by default
+        Subclasses set enabled to True and implement span() and inject()
+    """
+
+    enabled = False
+
+    def span(self, name, **attributes):
+        """
+        Context manager for a span around its block, attributes can be added with set_attribute()
+        """
+        return _NULL_SPAN
+
+    def inject(self, headers):
+        """
+        Adds the trace context of the current span to the headers of an outgoing request
+        """
+        return headers
+
+
+class OpenTelemetryTracer(SandTracer):
+    """
+    Records spans with the OpenTelemetry API
+        tracer_provider defaults to the global one the application configured
+        propagate sends the trace context of each SandClient attempt downstream with the
+        globally configured propagator, W3C traceparent by default
+    """
+
+    enabled = True
+
+    def __init__(self, tracer_provider=None, propagate=True):
+        from opentelemetry import trace
+        from opentelemetry import propagate as otel_propagate
+        self.tracer = trace.get_tracer('sand_python', tracer_provider=tracer_provider)
+        self.propagate = propagate
+        self.__inject = otel_propagate.inject
+
+    def span(self, name, **attributes):
+        # Errors are recorded on the span and it ends with an error status
+        return self.tracer.start_as_current_span('sand.' + name, attributes=attributes)
+
+    def inject(self, headers):
+        if self.propagate:
+            self.__inject(headers)
+        return headers
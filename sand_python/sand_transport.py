@@ -0,0 +1,78 @@
+"""sand_transport.py holds the pooled HTTP transport shared by SandService and SandClient
+
+    SandTransport: keep-alive requests.Session with a bounded connection pool per host
+"""
+
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class SandTransport():
+    """
+    Pooled, keep-alive HTTP transport
+        pool_connections is the number of hosts to keep connection pools for
+        pool_maxsize is the number of connections kept alive per host
+        pool_block makes callers wait for a free connection instead of opening extra ones
+    """
+
+    def __init__(self, pool_connections=10, pool_maxsize=10, pool_block=False, keep_alive=True):
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.pool_block = pool_block
+        self.keep_alive = keep_alive
+        self.__session = None
+        self.__lock = threading.Lock()
+
+    @property
+    def session(self):
+        # The session is created lazily so a transport can be built at import time
+        # and shared across pre-fork workers without sharing sockets
+        if self.__session is None:
+            with self.__lock:
+                if self.__session is None:
+                    self.__session = self.__build_session()
+        return self.__session
+
+    def __build_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.pool_connections, pool_maxsize=self.pool_maxsize, pool_block=self.pool_block)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        if not self.keep_alive:
+            session.headers['Connection'] = 'close'
+        return session
+
+    def warm_up(self, urls, timeout=3.05):
+        """
+        Opens a pooled connection to each of urls ahead of the first request, so it does not pay
+        for the DNS lookup, TCP connect and TLS handshake. The connection is opened with a HEAD
+        request, any response counts as ready as the connection is then kept in the pool.
+        Returns a dict of url to True, or the error the connection failed with
+        """
+        result = {}
+        for url in urls:
+            try:
+                # Through the session like post() and send(), so it lands in the pool they use
+                self.session.head(url, timeout=timeout, allow_redirects=False)
+                result[url] = True
+            except requests.RequestException as e:
+                # One bad host must not fail the others
+                result[url] = e
+        return result
+
+    def post(self, url, **kwargs):
+        return self.session.post(url, **kwargs)
+
+    def send(self, prepared_request, **kwargs):
+        # Same proxy and CA bundle settings from the environment as post(), so both share pools
+        settings = self.session.merge_environment_settings(prepared_request.url, kwargs.pop('proxies', None) or {}, kwargs.pop('stream', None),
+                                                           kwargs.pop('verify', None), kwargs.pop('cert', None))
+        kwargs.update(settings)
+        return self.session.send(prepared_request, **kwargs)
+
+    def close(self):
+        with self.__lock:
+            if self.__session is not None:
+                self.__session.close()
+                self.__session = None
@@ -1,4 +1,7 @@
 from datetime import datetime, timedelta
+import asyncio
+import threading
+import time
 import requests
 import mock
 import os
@@ -7,6 +10,19 @@ from werkzeug.contrib.cache import FileSystemCache, SimpleCache
 from .sand_exceptions import SandError
 from .sand_service import SandService
 from .sand_client import SandClient
+from .sand_transport import SandTransport
+from .sand_singleflight import SingleFlight
+from .sand_cache import LocalCache, TieredCache
+from .sand_async import AsyncSandService, AsyncSandClient, AsyncSandTransport
+from .sand_jwt import JwtVerifier
+from .sand_metrics import SandMetrics, StatsdMetrics, PrometheusMetrics
+from .sand_retry import RetryPolicy, RequestBody
+from .sand_circuit import CircuitBreaker
+from .sand_exceptions import SandUnavailableError
+from .sand_time import parse_rfc3339_timestamp
+from .sand_shared_cache import SharedCache
+from .sand_tracing import SandTracer
+from .sand_middleware import SandWSGIMiddleware, SandASGIMiddleware, validate_request_once, validate_request_once_async
 
 ####   To run the tests use the following command
 ####   pytest --pyargs test.py
@@ -21,9 +37,12 @@ class MockResponse:
     def json(self):
         return self.json_data
 
+    def close(self):
+        pass
+
 def mocked_requests_response1(*args, **kwargs):
     if args[0] == 'http://sand-py-test/warden/token/allowed':
-        curr = datetime.now()
+        curr = datetime.utcnow()
         dt = timedelta(seconds=3599)
         iat = curr.strftime("%Y-%m-%dT%H:%M:%SZ")
         exp_date = (curr + dt).strftime("%Y-%m-%dT%H:%M:%S.974664101Z")
@@ -90,7 +109,7 @@ SAND_CACHE = FileSystemCache(SAND_CACHE_DIR)
 ###### Test Sand Service (Incoming Requests)
 ###### This tests the authentication method by importing sand directly
 # Test successful validation
-@mock.patch('sand_python.sand_service.requests.post', side_effect=mocked_requests_response1)
+@mock.patch('sand_python.sand_transport.requests.Session.post', side_effect=mocked_requests_response1)
 def test_sand_service(mock1):
     sand = SandService('http://sand-py-test', SAND_TOKEN_PATH, SAND_TOKEN_VERIFY_PATH, 'A', 'B', 'C', 'D', SAND_CACHE)
     is_valid = sand.validate_request(sand_req_from_client.headers)['allowed']
@@ -104,7 +123,7 @@ def test_sand_service(mock1):
     sand.cache.clear()
 
 # Test denied request after getting good service token
-@mock.patch('sand_python.sand_service.requests.post', side_effect=mocked_requests_response2)
+@mock.patch('sand_python.sand_transport.requests.Session.post', side_effect=mocked_requests_response2)
 def test_sand_service_request_denied(mock1):
     sand = SandService('http://sand-py-test', SAND_TOKEN_PATH, SAND_TOKEN_VERIFY_PATH, 'A', 'B', 'C', 'D', SAND_CACHE)
     is_valid = sand.validate_request(sand_req_from_client.headers)['allowed']
@@ -113,7 +132,7 @@ def test_sand_service_request_denied(mock1):
     sand.cache.clear()
 
 # Also test denied request after getting good service token but for invalid request
-@mock.patch('sand_python.sand_service.requests.post', side_effect=mocked_requests_response4)
+@mock.patch('sand_python.sand_transport.requests.Session.post', side_effect=mocked_requests_response4)
 def test_sand_service_request_denied_2(mock1):
     try:
         sand = SandService('http://sand-py-test', SAND_TOKEN_PATH, SAND_TOKEN_VERIFY_PATH, 'A', 'B', 'C', 'D', SAND_CACHE)
@@ -138,7 +157,7 @@ def test_sand_service_invalid_url():
     sand.cache.clear()
 
 # Test failed to get service token from sand due to authentication issue
-@mock.patch('sand_python.sand_service.requests.post', side_effect=mocked_requests_response3)
+@mock.patch('sand_python.sand_transport.requests.Session.post', side_effect=mocked_requests_response3)
 def test_sand_service_cannot_get_token(mock1):
     try:
         sand = SandService('http://sand-py-test', SAND_TOKEN_PATH, SAND_TOKEN_VERIFY_PATH, 'A', 'B', 'C', 'D', SAND_CACHE)
@@ -161,7 +180,7 @@ app_sand_service = SandService(SAND_TOKEN_SITE,
                                SAND_CACHE)
 
 # Test Sand Client with external service down
-@mock.patch('sand_python.sand_service.requests.post', side_effect=mocked_requests_response1)
+@mock.patch('sand_python.sand_transport.requests.Session.post', side_effect=mocked_requests_response1)
 def test_sand_request_external_service_down(mock1):
     #create_global_sand(client)
     sand_req = SandClient()
@@ -173,8 +192,8 @@ def test_sand_request_external_service_down(mock1):
         assert True is False
 
 # Test Sand Client successfully
-@mock.patch('sand_python.sand_service.requests.post', side_effect=mocked_requests_response1)
-@mock.patch('sand_python.sand_client.requests.Session.send', side_effect=mocked_requests_response5)
+@mock.patch('sand_python.sand_transport.requests.Session.post', side_effect=mocked_requests_response1)
+@mock.patch('sand_python.sand_transport.requests.Session.send', side_effect=mocked_requests_response5)
 def test_sand_request(mock1, mock2):
     #create_global_sand(client)
     sand_req = SandClient()
@@ -182,19 +201,21 @@ def test_sand_request(mock1, mock2):
     assert resp.status_code is 200
 
 # Test Sand Client with retries
-@mock.patch('sand_python.sand_service.requests.post', side_effect=mocked_requests_response1)
-@mock.patch('sand_python.sand_client.requests.Session.send', side_effect=mocked_requests_response5)
+@mock.patch('sand_python.sand_transport.requests.Session.post', side_effect=mocked_requests_response1)
+@mock.patch('sand_python.sand_transport.requests.Session.send', side_effect=mocked_requests_response5)
 def test_sand_request_retries(mock1, mock2):
     #create_global_sand(client)
     sand_req = SandClient()
     start_time = datetime.utcnow()
-    # This should stall the test for a bit because of retrying with sleeps inbetween
-    sand_req.request('PUT', 'http://some-something/', app_sand_service, max_retries=3)
+    # A 401 is retried right away with a new token instead of sleeping
+    resp = sand_req.request('PUT', 'http://some-something/', app_sand_service, max_retries=3)
     total_time = (datetime.utcnow() - start_time).total_seconds()
-    assert total_time > 5
+    assert resp.status_code == 401
+    assert mock1.call_count == 3
+    assert total_time < 1
 
 # Test Sand Client with timeout
-@mock.patch('sand_python.sand_service.requests.post', side_effect=mocked_requests_response1)
+@mock.patch('sand_python.sand_transport.requests.Session.post', side_effect=mocked_requests_response1)
 def test_sand_request_timeout(mock1):
     sand_req = SandClient()
     start_time = datetime.utcnow()
@@ -208,8 +229,8 @@ def test_sand_request_timeout(mock1):
     assert total_time > 9 and total_time < 12
 
 # Test Positional Arguments
-@mock.patch('sand_python.sand_service.requests.post', side_effect=mocked_requests_response1)
-@mock.patch('sand_python.sand_client.requests.Session.send', side_effect=mocked_requests_response5)
+@mock.patch('sand_python.sand_transport.requests.Session.post', side_effect=mocked_requests_response1)
+@mock.patch('sand_python.sand_transport.requests.Session.send', side_effect=mocked_requests_response5)
 def test_sand_request_arguments(mock1, mock2):
     sand_req = SandClient()
     headers = {"Ocr-Type": 'enhanced', "Content-Type": 'application/json', 'X-DES-Client': 'FDS', 'X-Coupa-Instance': 'test', 'X-Correlation-Id': '12345'}
@@ -218,3 +239,808 @@ def test_sand_request_arguments(mock1, mock2):
         sand_req.request(sand_api=app_sand_service, request_headers=headers, method='POST', timeout=10, request_url='http://some-something/')
     except:
         assert True is False
+
+# Test that the service and client share one pooled session
+@mock.patch('sand_python.sand_transport.requests.Session.post', side_effect=mocked_requests_response1)
+@mock.patch('sand_python.sand_transport.requests.Session.send', side_effect=mocked_requests_response5)
+def test_sand_transport_shared_session(mock1, mock2):
+    transport = SandTransport(pool_connections=2, pool_maxsize=4)
+    sand = SandService('http://sand-py-test', SAND_TOKEN_PATH, SAND_TOKEN_VERIFY_PATH, 'A', 'B', 'C', 'D', SimpleCache(), transport=transport)
+    session = transport.session
+    SandClient().request('POST', 'http://some-something/', sand)
+    sand.validate_request(sand_req_from_client.headers)
+    assert transport.session is session
+    assert session.get_adapter('https://sand-py-test')._pool_maxsize == 4
+
+def mocked_slow_requests_response1(*args, **kwargs):
+    time.sleep(0.2)
+    return mocked_requests_response1(*args, **kwargs)
+
+# Test that concurrent cache misses for the same token make a single call to each SAND endpoint
+@mock.patch('sand_python.sand_transport.requests.Session.post', side_effect=mocked_slow_requests_response1)
+def test_sand_service_single_flight(mock1):
+    sand = SandService('http://sand-py-test', SAND_TOKEN_PATH, SAND_TOKEN_VERIFY_PATH, 'A', 'B', 'C', 'D', SimpleCache())
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(sand.validate_request(sand_req_from_client.headers))) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(results) == 8 and all(r['allowed'] is True for r in results)
+    assert mock1.call_count == 2
+
+# Test that a caller waiting on a lock held by another process reads the result from the cache
+def test_single_flight_cache_lock():
+    cache = SimpleCache()
+    flight = SingleFlight(cache, lock_timeout=2, poll_interval=0.01)
+    cache.add('key/lock', 'other-process', 2)
+    threading.Timer(0.1, lambda: cache.set('key', 'from other process')).start()
+    result = flight.do('key', lambda: 'from this process', check=lambda: cache.get('key'))
+    assert result == 'from other process'
+
+# Test that the service token is renewed in the background before it expires
+def test_sand_service_token_refresh_ahead():
+    tokens = iter(['token1', 'token2'])
+    def mocked_token_response(*args, **kwargs):
+        return MockResponse({"access_token":next(tokens), "expires_in":2, "scope":"sand_scope", "token_type":"bearer"}, 200)
+    with mock.patch('sand_python.sand_transport.requests.Session.post', side_effect=mocked_token_response) as mock1:
+        sand = SandService('http://sand-py-test', SAND_TOKEN_PATH, SAND_TOKEN_VERIFY_PATH, 'A', 'B', 'C', 'D', SimpleCache(), token_refresh_ratio=0.5)
+        assert sand.get_token() == 'token1'
+        assert sand.get_token() == 'token1'
+        time.sleep(1.1)
+        # Still served from cache while the refresh happens in the background
+        assert sand.get_token() == 'token1'
+        time.sleep(0.2)
+        assert mock1.call_count == 2
+        assert sand.get_token() == 'token2'
+
+# Test that a process refreshes a token another process fetched, and backs off after any refresh error
+def test_sand_service_token_refresh_ahead_shared():
+    tokens = iter(['token1', 'token2'])
+    def mocked_token_response(*args, **kwargs):
+        return MockResponse({"access_token":next(tokens), "expires_in":2, "scope":"sand_scope", "token_type":"bearer"}, 200)
+    shared = SimpleCache()
+    with mock.patch('sand_python.sand_transport.requests.Session.post', side_effect=mocked_token_response) as mock1:
+        fetcher = SandService('http://sand-py-test', SAND_TOKEN_PATH, SAND_TOKEN_VERIFY_PATH, 'A', 'B', 'C', 'D', shared, token_refresh_ratio=0.5)
+        assert fetcher.get_token() == 'token1'
+        sand = SandService('http://sand-py-test', SAND_TOKEN_PATH, SAND_TOKEN_VERIFY_PATH, 'A', 'B', 'C', 'D', shared, token_refresh_ratio=0.5)
+        assert sand.get_token() == 'token1'
+        time.sleep(1.1)
+    with mock.patch('sand_python.sand_transport.requests.Session.post', side_effect=requests.exceptions.ChunkedEncodingError('broken')) as mock2:
+        assert sand.get_token() == 'token1'
+        time.sleep(0.2)
+        # The failed refresh is retried after TOKEN_REFRESH_RETRY_SECS, not on every call
+        assert sand.get_token() == 'token1'
+        time.sleep(0.2)
+        assert mock2.call_count == 1
+    with mock.patch('sand_python.sand_transport.requests.Session.post', side_effect=mocked_token_response) as mock1:
+        # The other process sees the token is due and refreshes it
+        assert fetcher.get_token() == 'token1'
+        time.sleep(0.2)
+        assert mock1.call_count == 1
+        assert sand.get_token() == 'token2'
+
+# Test that the in-process tier answers repeated lookups and falls through to the shared cache
+@mock.patch('sand_python.sand_transport.requests.Session.post', side_effect=mocked_requests_response1)
+def test_sand_service_local_cache(mock1):
+    shared = SimpleCache()
+    sand = SandService('http://sand-py-test', SAND_TOKEN_PATH, SAND_TOKEN_VERIFY_PATH, 'A', 'B', 'C', 'D', shared, local_cache_size=10)
+    sand.validate_request(sand_req_from_client.headers)
+    shared.clear()
+    assert sand.validate_request(sand_req_from_client.headers)['allowed'] is True
+    assert mock1.call_count == 2
+    assert sand.cache_stats()['hits'] == 1
+
+def test_local_cache_eviction_and_ttl():
+    local = LocalCache(max_entries=2, default_timeout=60)
+    cache = TieredCache(local, SimpleCache())
+    cache.set('a', 1, 3600)
+    cache.set('b', 2, 0.05)
+    cache.set('c', 3, 3600)
+    # 'a' was evicted from the local tier but is still in the shared tier
+    assert len(local) == 2
+    assert cache.get('a') == 1
+    time.sleep(0.1)
+    assert local.get('b') is None
+    # Values read from the shared tier stay locally no longer than their remaining TTL, if known
+    cache = TieredCache(LocalCache(default_timeout=60), SimpleCache(), lambda value: value.get('ttl'))
+    cache.remote.set('d', {'ttl': 0.05}, 3600)
+    cache.remote.set('e', {}, 3600)
+    assert cache.get('d') is not None and cache.get('e') is not None
+    assert cache.local.get('e') is None
+    time.sleep(0.1)
+    assert cache.local.get('d') is None
+
+###### Test asyncio API
+async def mocked_async_requests_response1(*args, **kwargs):
+    await asyncio.sleep(0.05)
+    return mocked_requests_response1(*args, **kwargs)
+
+async def mocked_async_requests_response5(method, *args, **kwargs):
+    return MockResponse({"success":"some response"}, 401 if method == 'PUT' else 200)
+
+# Test async validation shares the sync cache keys and coalesces concurrent misses
+@mock.patch.object(AsyncSandTransport, 'post', side_effect=mocked_async_requests_response1)
+def test_async_sand_service(mock1):
+    cache = SimpleCache()
+    async def run():
+        sand = AsyncSandService('http://sand-py-test', SAND_TOKEN_PATH, SAND_TOKEN_VERIFY_PATH, 'A', 'B', 'C', 'D', cache)
+        return await asyncio.gather(*[sand.validate_request(sand_req_from_client.headers) for _ in range(5)])
+    results = asyncio.run(run())
+    assert all(r['allowed'] is True for r in results)
+    assert mock1.call_count == 2
+    sync_sand = SandService('http://asdfghjkl', SAND_TOKEN_PATH, SAND_TOKEN_VERIFY_PATH, 'A', 'B', 'C', 'D', cache)
+    assert sync_sand.validate_request(sand_req_from_client.headers)['allowed'] is True
+    async def run_many():
+        sand = AsyncSandService('http://sand-py-test', SAND_TOKEN_PATH, SAND_TOKEN_VERIFY_PATH, 'A', 'B', 'C', 'D', cache, local_cache_size=10)
+        results = await sand.validate_many([(sand_req_from_client.headers, None), ({}, None)])
+        return results, sand.cache_stats()
+    results, stats = asyncio.run(run_many())
+    assert results[0]['allowed'] is True and isinstance(results[1], SandError)
+    assert stats['misses'] == 1
+
+# Test async client retries a 401 with a fresh token
+@mock.patch.object(AsyncSandTransport, 'post', side_effect=mocked_async_requests_response1)
+@mock.patch.object(AsyncSandTransport, 'request', side_effect=mocked_async_requests_response5)
+@mock.patch('asyncio.sleep', new_callable=mock.AsyncMock)
+def test_async_sand_request(mock_sleep, mock_request, mock_post):
+    async def run():
+        sand = AsyncSandService('http://sand-py-test', SAND_TOKEN_PATH, SAND_TOKEN_VERIFY_PATH, 'A', 'B', 'C', 'D', SimpleCache())
+        client = AsyncSandClient()
+        ok = await client.request('POST', 'http://some-something/', sand, request_body={"something":"something"})
+        denied = await client.request('PUT', 'http://some-something/', sand, max_retries=3)
+        return ok, denied
+    ok, denied = asyncio.run(run())
+    assert ok.status_code == 200
+    assert denied.status_code == 401
+    assert mock_request.call_count == 4
+    assert [c for c in mock_sleep.await_args_list if c != mock.call(0.05)] == []
+    # Token cleared and fetched again before each retry
+    assert mock_post.call_count == 3
+
+# Test async denials go to the negative cache, signed tokens are verified in-process and metrics are reported
+def test_async_sand_service_options():
+    import jwt
+    private_key, jwks = make_jwt_keys()
+    now = int(time.time())
+    signed_token = jwt.encode({"sub": "client", "aud": "sand-development", "iat": now, "exp": now + 3600, "scope": "C"}, private_key, algorithm="RS256", headers={"kid": "key1"})
+    async def mocked_denied(*args, **kwargs):
+        return mocked_requests_response2(*args, **kwargs)
+    shared = SimpleCache()
+    metrics = RecordingMetrics()
+    with mock.patch.object(AsyncSandTransport, 'post', side_effect=mocked_denied) as mock_post, \
+            mock.patch('sand_python.sand_transport.requests.Session.get', return_value=MockResponse(jwks, 200)):
+        verifier = JwtVerifier('http://sand-py-test/.well-known/jwks.json', audience='sand-development')
+        async def run():
+            sand = AsyncSandService('http://sand-py-test', SAND_TOKEN_PATH, SAND_TOKEN_VERIFY_PATH, 'A', 'B', 'C', 'D', shared, jwt_verifier=verifier, negative_cache_ttl=60, metrics=metrics)
+            denied = [(await sand.validate_request(sand_req_from_client.headers))['allowed'] for _ in range(3)]
+            signed = await sand.validate_request({'Authorization': 'Bearer ' + signed_token})
+            return denied, signed
+        denied, signed = asyncio.run(run())
+    assert denied == [False, False, False]
+    assert signed['allowed'] is True and signed['sub'] == 'client'
+    # One token fetch and one verify, the denial is not stored in sand_cache
+    assert mock_post.call_count == 2
+    key = AsyncSandService('http://sand-py-test', SAND_TOKEN_PATH, SAND_TOKEN_VERIFY_PATH, 'A', 'B', 'C', 'D', shared)._get_client_token_cache_key('token', ['C'])
+    assert shared.get(key) is None
+    assert ('token_verify', {'status': 200, 'outcome': 'success'}) in metrics.timings
+
+# Test that cancelled SAND calls, like those of a client that disconnected, do not open the circuit
+@mock.patch.object(AsyncSandTransport, 'post', side_effect=asyncio.CancelledError())
+def test_async_sand_service_cancelled(mock_post):
+    async def run():
+        sand = AsyncSandService('http://sand-py-test', SAND_TOKEN_PATH, SAND_TOKEN_VERIFY_PATH, 'A', 'B', 'C', 'D', SimpleCache(), circuit_failure_threshold=1)
+        for _ in range(3):
+            try:
+                await sand.get_token()
+            except asyncio.CancelledError:
+                pass
+            else:
+                assert True is False
+        return sand
+    sand = asyncio.run(run())
+    assert mock_post.call_count == 3
+    assert sand.token_circuit.state == CircuitBreaker.CLOSED
+
+###### Test local JWT verification
+def make_jwt_keys():
+    import json
+    import jwt
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    jwk = json.loads(jwt.algorithms.RSAAlgorithm.to_jwk(private_key.public_key()))
+    jwk.update({"kid": "key1", "use": "sig", "alg": "RS256"})
+    return private_key, {"keys": [jwk]}
+
+# Test that signed tokens are verified in-process and opaque tokens still go to SAND
+@mock.patch('sand_python.sand_transport.requests.Session.post', side_effect=mocked_requests_response1)
+def test_sand_service_jwt_verifier(mock_post):
+    import jwt
+    private_key, jwks = make_jwt_keys()
+    now = int(time.time())
+    claims = {"sub": "client", "aud": "sand-development", "iat": now, "exp": now + 3600, "scope": "C other"}
+    signed_token = jwt.encode(claims, private_key, algorithm="RS256", headers={"kid": "key1"})
+    with mock.patch('sand_python.sand_transport.requests.Session.get', return_value=MockResponse(jwks, 200)) as mock_get:
+        verifier = JwtVerifier('http://sand-py-test/.well-known/jwks.json', audience='sand-development')
+        sand = SandService('http://sand-py-test', SAND_TOKEN_PATH, SAND_TOKEN_VERIFY_PATH, 'A', 'B', 'C', 'D', SimpleCache(), jwt_verifier=verifier)
+        resp = sand.validate_request({'Authorization': 'Bearer ' + signed_token})
+        assert resp['allowed'] is True and resp['sub'] == 'client'
+        assert mock_post.call_count == 0
+        assert sand.validate_request({'Authorization': 'Bearer ' + signed_token}, {'scopes': ['missing']})['allowed'] is False
+        tampered = jwt.encode(dict(claims, sub="other"), make_jwt_keys()[0], algorithm="RS256", headers={"kid": "key1"})
+        assert sand.validate_request({'Authorization': 'Bearer ' + tampered})['allowed'] is False
+        assert sand.validate_request(sand_req_from_client.headers)['allowed'] is True
+        assert mock_post.call_count == 2
+        assert mock_get.call_count == 1
+
+# Test that a token issued by a clock ahead of ours goes to SAND and local denials are not kept forever
+@mock.patch('sand_python.sand_transport.requests.Session.post', side_effect=mocked_requests_response1)
+def test_sand_service_jwt_verifier_clock_skew(mock_post):
+    import jwt
+    private_key, jwks = make_jwt_keys()
+    now = int(time.time())
+    with mock.patch('sand_python.sand_transport.requests.Session.get', return_value=MockResponse(jwks, 200)):
+        verifier = JwtVerifier('http://sand-py-test/.well-known/jwks.json', audience='sand-development')
+        cache = SimpleCache()
+        sand = SandService('http://sand-py-test', SAND_TOKEN_PATH, SAND_TOKEN_VERIFY_PATH, 'A', 'B', 'C', 'D', cache, jwt_verifier=verifier)
+        claims = {"sub": "client", "aud": "sand-development", "exp": now + 3600, "scope": "C"}
+        # Within the default leeway
+        ahead = jwt.encode(dict(claims, iat=now + 2), private_key, algorithm="RS256", headers={"kid": "key1"})
+        assert sand.validate_request({'Authorization': 'Bearer ' + ahead})['allowed'] is True
+        assert mock_post.call_count == 0
+        # Past the leeway SAND decides
+        far_ahead = jwt.encode(dict(claims, iat=now + 60), private_key, algorithm="RS256", headers={"kid": "key1"})
+        assert verifier.verify(far_ahead, ['C']) is None
+        assert sand.validate_request({'Authorization': 'Bearer ' + far_ahead})['allowed'] is True
+        assert mock_post.call_count == 2
+        expired = jwt.encode(dict(claims, iat=now - 3600, exp=now - 60), private_key, algorithm="RS256", headers={"kid": "key1"})
+        with mock.patch.object(cache, 'set', wraps=cache.set) as mock_set:
+            assert sand.validate_request({'Authorization': 'Bearer ' + expired})['allowed'] is False
+            assert mock_set.call_args[0][2] == SandService.LOCAL_DENIAL_CACHE_SECS
+
+# Test batch validation with cache hits, duplicates, misses and per item errors
+@mock.patch('sand_python.sand_transport.requests.Session.post', side_effect=mocked_requests_response1)
+def test_sand_service_validate_many(mock1):
+    sand = SandService('http://sand-py-test', SAND_TOKEN_PATH, SAND_TOKEN_VERIFY_PATH, 'A', 'B', 'C', 'D', SimpleCache())
+    sand.validate_request({'Authorization': 'Bearer cached'})
+    assert mock1.call_count == 2
+    items = [
+        ({'Authorization': 'Bearer token1'}, None),
+        ({'Authorization': 'Bearer cached'}, None),
+        ({}, None),
+        ({'Authorization': 'Bearer token1'}, {}),
+        ({'Authorization': 'Bearer token2'}, {'scopes': ['other']}),
+    ]
+    results = sand.validate_many(items)
+    assert [r['allowed'] for i, r in enumerate(results) if i != 2] == [True, True, True, True]
+    assert isinstance(results[2], SandError) and results[2].code == 401
+    # One verify call per distinct miss, the service token is already cached
+    assert mock1.call_count == 4
+
+# Test that denied tokens are answered from the negative cache and are not stored in sand_cache
+@mock.patch('sand_python.sand_transport.requests.Session.post', side_effect=mocked_requests_response2)
+def test_sand_service_negative_cache(mock1):
+    shared = SimpleCache()
+    sand = SandService('http://sand-py-test', SAND_TOKEN_PATH, SAND_TOKEN_VERIFY_PATH, 'A', 'B', 'C', 'D', shared, negative_cache_ttl=0.2, negative_cache_size=10)
+    for _ in range(3):
+        assert sand.validate_request(sand_req_from_client.headers)['allowed'] is False
+    assert mock1.call_count == 2
+    assert sand.validate_many([(sand_req_from_client.headers, None)])[0]['allowed'] is False
+    assert mock1.call_count == 2
+    time.sleep(0.3)
+    assert sand.validate_request(sand_req_from_client.headers)['allowed'] is False
+    assert mock1.call_count == 3
+
+###### Test metrics
+class RecordingMetrics(SandMetrics):
+    enabled = True
+
+    def __init__(self):
+        self.timings = []
+        self.counters = []
+
+    def increment(self, name, value=1, tags=None):
+        self.counters.append((name, tags))
+
+    def timing(self, name, seconds, tags=None):
+        self.timings.append((name, tags))
+
+# Test that cache lookups, SAND calls and client attempts are reported with their tags
+@mock.patch('sand_python.sand_transport.requests.Session.post', side_effect=mocked_requests_response1)
+@mock.patch('sand_python.sand_transport.requests.Session.send', side_effect=mocked_requests_response5)
+@mock.patch('sand_python.sand_client.time.sleep')
+def test_sand_metrics(mock_sleep, mock_send, mock_post):
+    metrics = RecordingMetrics()
+    sand = SandService('http://sand-py-test', SAND_TOKEN_PATH, SAND_TOKEN_VERIFY_PATH, 'A', 'B', 'C', 'D', SimpleCache(), metrics=metrics)
+    sand.validate_request(sand_req_from_client.headers)
+    sand.validate_request(sand_req_from_client.headers)
+    SandClient().request('PUT', 'http://some-something/', sand, max_retries=2)
+    assert ('token_fetch', {'status': 200, 'outcome': 'success'}) in metrics.timings
+    assert ('token_verify', {'status': 200, 'outcome': 'success'}) in metrics.timings
+    assert [t['result'] for n, t in metrics.timings if n == 'cache_get' and t['kind'] == 'client_token'] == ['miss', 'hit']
+    assert ('client_request', {'attempt': 2, 'status': 401, 'outcome': 'success'}) in metrics.timings
+    assert metrics.counters.count(('client_retry', {'reason': 'unauthorized'})) == 1
+
+def test_statsd_metrics():
+    client = mock.Mock()
+    metrics = StatsdMetrics(client)
+    with metrics.timer('token_verify') as timer:
+        timer.tag('status', 200)
+    metrics.increment('client_retry', tags={'reason': 'unauthorized'})
+    assert client.timing.call_args[0][0] == 'sand.token_verify.success.200'
+    client.incr.assert_called_once_with('sand.client_retry.unauthorized', 1)
+    # The default sink does nothing
+    assert SandMetrics().timer('token_verify').tag('status', 200) is None
+
+# Test that instances sharing a registry share their collectors, and that sink errors do not fail requests
+@mock.patch('sand_python.sand_transport.requests.Session.post', side_effect=mocked_requests_response1)
+def test_prometheus_metrics(mock_post):
+    import prometheus_client
+    registry = prometheus_client.CollectorRegistry()
+    services = [SandService('http://sand-py-test', SAND_TOKEN_PATH, SAND_TOKEN_VERIFY_PATH, 'A', 'B', 'C', 'D', SimpleCache(), metrics=PrometheusMetrics(registry)) for _ in range(2)]
+    for sand in services:
+        assert sand.validate_request(sand_req_from_client.headers)['allowed'] is True
+    assert registry.get_sample_value('sand_token_verify_seconds_count', {'outcome': 'success', 'status': '200'}) == 2
+    # Many threads creating the same collectors at once
+    metrics = [PrometheusMetrics(registry, prefix='threads') for _ in range(8)]
+    threads = [threading.Thread(target=m.increment, args=('client_retry',), kwargs={'tags': {'reason': 'status'}}) for m in metrics]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert registry.get_sample_value('threads_client_retry_total', {'reason': 'status'}) == 8
+    class BrokenMetrics(SandMetrics):
+        enabled = True
+        def timing(self, name, seconds, tags=None):
+            raise ValueError('sink is down')
+    sand = SandService('http://sand-py-test', SAND_TOKEN_PATH, SAND_TOKEN_VERIFY_PATH, 'A', 'B', 'C', 'D', SimpleCache(), metrics=BrokenMetrics())
+    assert sand.validate_request(sand_req_from_client.headers)['allowed'] is True
+
+###### Test retry policy
+class MockHeadersResponse(MockResponse):
+    def __init__(self, json_data, status_code, headers=None):
+        MockResponse.__init__(self, json_data, status_code)
+        self.headers = headers or {}
+
+# Test that 503s are retried for idempotent methods honoring Retry-After, and not for POST
+@mock.patch('sand_python.sand_transport.requests.Session.post', side_effect=mocked_requests_response1)
+@mock.patch('sand_python.sand_client.time.sleep')
+def test_sand_request_retry_policy(mock_sleep, mock_post):
+    responses = [MockHeadersResponse(None, 503, {'Retry-After': '2'}), MockHeadersResponse(None, 429), MockHeadersResponse({}, 200)]
+    with mock.patch('sand_python.sand_transport.requests.Session.send', side_effect=responses) as mock_send:
+        resp = SandClient(retry_policy=RetryPolicy(base_delay=0.5)).request('GET', 'http://some-something/', app_sand_service, max_retries=3)
+    assert resp.status_code == 200
+    assert mock_send.call_count == 3
+    assert mock_sleep.call_args_list[0] == mock.call(2.0)
+    assert 0 <= mock_sleep.call_args_list[1][0][0] <= 1.0
+    with mock.patch('sand_python.sand_transport.requests.Session.send', return_value=MockHeadersResponse(None, 503)) as mock_send:
+        resp = SandClient().request('POST', 'http://some-something/', app_sand_service, max_retries=3)
+    assert resp.status_code == 503
+    assert mock_send.call_count == 1
+
+# Test that connection errors are retried for idempotent methods within the timeout budget
+@mock.patch('sand_python.sand_transport.requests.Session.post', side_effect=mocked_requests_response1)
+def test_sand_request_retry_deadline(mock_post):
+    with mock.patch('sand_python.sand_transport.requests.Session.send', side_effect=[requests.ConnectionError(), MockHeadersResponse({}, 200)]) as mock_send:
+        resp = SandClient(retry_policy=RetryPolicy(base_delay=0.01)).request('GET', 'http://some-something/', app_sand_service, max_retries=3)
+    assert resp.status_code == 200
+    assert mock_send.call_count == 2
+    # Retry-After longer than the remaining budget ends the retries
+    with mock.patch('sand_python.sand_transport.requests.Session.send', return_value=MockHeadersResponse(None, 503, {'Retry-After': '30'})) as mock_send:
+        start_time = time.time()
+        resp = SandClient().request('GET', 'http://some-something/', app_sand_service, max_retries=3, timeout=5.0)
+    assert resp.status_code == 503
+    assert mock_send.call_count == 1
+    assert time.time() - start_time < 1
+    with mock.patch('sand_python.sand_transport.requests.Session.send', side_effect=requests.ConnectionError()) as mock_send:
+        try:
+            SandClient().request('POST', 'http://some-something/', app_sand_service, max_retries=3)
+        except SandError as e:
+            assert e.code == 502
+        else:
+            assert True is False
+    assert mock_send.call_count == 1
+    # (connect, read) timeouts are shrunk to the time left as well
+    policy = RetryPolicy()
+    deadline = time.time() + 4
+    connect, read = policy.attempt_timeout((3.05, 10), deadline)
+    assert connect == 3.05 and 0.9 < read <= 0.95
+    assert policy.attempt_timeout((3.05, None), deadline)[1] <= 0.95
+
+###### Test circuit breaker and grace mode
+def mocked_requests_response_timeout(*args, **kwargs):
+    if args[0] == 'http://sand-py-test/oauth2/token':
+        return mocked_requests_response1(*args, **kwargs)
+    raise requests.exceptions.ReadTimeout()
+
+# Test that SAND calls carry a timeout and the verify circuit opens after repeated failures
+def test_sand_service_circuit_breaker():
+    sand = SandService('http://sand-py-test', SAND_TOKEN_PATH, SAND_TOKEN_VERIFY_PATH, 'A', 'B', 'C', 'D', SimpleCache(), circuit_failure_threshold=2, circuit_recovery_secs=0.2)
+    with mock.patch('sand_python.sand_transport.requests.Session.post', side_effect=mocked_requests_response_timeout) as mock1:
+        for i in range(4):
+            try:
+                sand.validate_request({'Authorization': 'Bearer token' + str(i)})
+            except SandUnavailableError as e:
+                assert e.code == 502
+            else:
+                assert True is False
+        # Token fetch and two verify timeouts, then the open circuit fails fast
+        assert mock1.call_count == 3
+        assert mock1.call_args[1]['timeout'] == (3.05, 10)
+        assert sand.verify_circuit.state == CircuitBreaker.OPEN
+    time.sleep(0.25)
+    with mock.patch('sand_python.sand_transport.requests.Session.post', side_effect=mocked_requests_response1):
+        assert sand.validate_request({'Authorization': 'Bearer token5'})['allowed'] is True
+    assert sand.verify_circuit.state == CircuitBreaker.CLOSED
+
+# Test that an unexpected error of the trial call does not leave the circuit stuck half open
+def test_sand_service_circuit_breaker_unexpected_error():
+    sand = SandService('http://sand-py-test', SAND_TOKEN_PATH, SAND_TOKEN_VERIFY_PATH, 'A', 'B', 'C', 'D', SimpleCache(), circuit_failure_threshold=1, circuit_recovery_secs=0.2)
+    with mock.patch('sand_python.sand_transport.requests.Session.post', side_effect=requests.exceptions.ChunkedEncodingError('broken')):
+        try:
+            sand.get_token()
+        except requests.exceptions.ChunkedEncodingError:
+            pass
+        else:
+            assert True is False
+        assert sand.token_circuit.state == CircuitBreaker.OPEN
+    time.sleep(0.25)
+    with mock.patch('sand_python.sand_transport.requests.Session.post', side_effect=mocked_requests_response1):
+        assert sand.get_token() == 'some token'
+    assert sand.token_circuit.state == CircuitBreaker.CLOSED
+    # A trial that never reports back is replaced after recovery_secs
+    circuit = CircuitBreaker(failure_threshold=1, recovery_secs=0.2)
+    circuit.record_failure()
+    time.sleep(0.25)
+    assert circuit.allow() is True
+    assert circuit.allow() is False
+    time.sleep(0.25)
+    assert circuit.allow() is True
+
+# Test that expired allowed decisions are served during an outage within the grace period
+def test_sand_service_grace_period():
+    def mocked_short_lived(*args, **kwargs):
+        resp = mocked_requests_response1(*args, **kwargs)
+        if args[0] == 'http://sand-py-test/warden/token/allowed':
+            curr = datetime.utcnow()
+            resp.json_data['iat'] = curr.strftime("%Y-%m-%dT%H:%M:%SZ")
+            resp.json_data['exp'] = (curr + timedelta(seconds=1)).strftime("%Y-%m-%dT%H:%M:%SZ")
+        return resp
+    sand = SandService('http://sand-py-test', SAND_TOKEN_PATH, SAND_TOKEN_VERIFY_PATH, 'A', 'B', 'C', 'D', SimpleCache(), grace_period_secs=60)
+    with mock.patch('sand_python.sand_transport.requests.Session.post', side_effect=mocked_short_lived):
+        sand.validate_request(sand_req_from_client.headers)
+    time.sleep(1.1)
+    with mock.patch('sand_python.sand_transport.requests.Session.post', side_effect=requests.ConnectionError()):
+        assert sand.validate_request(sand_req_from_client.headers)['allowed'] is True
+        try:
+            sand.validate_request({'Authorization': 'Bearer unseen'})
+        except SandUnavailableError as e:
+            assert e.code == 502
+        else:
+            assert True is False
+    # A proxy answers for SAND with an HTML page
+    class HtmlResponse(MockResponse):
+        def json(self):
+            raise ValueError('No JSON object could be decoded')
+    def mocked_html_503(*args, **kwargs):
+        if args[0] == 'http://sand-py-test/warden/token/allowed':
+            return HtmlResponse('<html>503 Service Unavailable</html>', 503)
+        return mocked_requests_response1(*args, **kwargs)
+    with mock.patch('sand_python.sand_transport.requests.Session.post', side_effect=mocked_html_503):
+        assert sand.validate_request(sand_req_from_client.headers)['allowed'] is True
+        try:
+            sand.validate_request({'Authorization': 'Bearer unseen'})
+        except SandUnavailableError as e:
+            assert e.code == 502 and '503' in e.get()
+        else:
+            assert True is False
+
+# Test hashed cache keys and compact cached values
+@mock.patch('sand_python.sand_transport.requests.Session.post', side_effect=mocked_requests_response1)
+def test_sand_service_compact_cache(mock1):
+    cache = SimpleCache()
+    long_token = 'x' * 1000
+    sand = SandService('http://sand-py-test', SAND_TOKEN_PATH, SAND_TOKEN_VERIFY_PATH, 'A', 'B', 'C', 'D', cache, cache_root='root', hashed_cache_keys=True, compact_cache_values=True)
+    first = sand.validate_request({'Authorization': 'Bearer ' + long_token})
+    assert first['allowed'] is True and 'iat' in first
+    key = sand._get_client_token_cache_key(long_token, ['C'])
+    assert key.startswith('root/client_tokens/') and len(key) == len('root/client_tokens/') + 64
+    assert long_token not in key
+    assert isinstance(cache.get(key), tuple)
+    cached = sand.validate_request({'Authorization': 'Bearer ' + long_token})
+    assert cached == {'allowed': True, 'sub': first['sub'], 'scopes': first['scopes'], 'exp': first['exp']}
+    assert sand.validate_many([({'Authorization': 'Bearer ' + long_token}, None)]) == [cached]
+    assert mock1.call_count == 2
+    # A backend serializing with JSON gives the tuple back as a list
+    cache.set(key, list(cache.get(key)))
+    assert sand.validate_request({'Authorization': 'Bearer ' + long_token}) == cached
+
+# Test the fixed format RFC 3339 parser against dateutil
+def test_parse_rfc3339_timestamp():
+    from dateutil import parser, tz
+    for value in ["2016-09-06T08:32:59.71-07:00", "2016-09-06T15:32:59.974664101Z", "2016-09-06T15:32:59+05:30", "Tue, 06 Sep 2016 15:32:59 GMT"]:
+        expected = (parser.parse(value) - datetime(1970, 1, 1, tzinfo=tz.tzutc())).total_seconds()
+        assert abs(parse_rfc3339_timestamp(value) - expected) < 1e-6
+
+# Test bearer token extraction without the regex
+def test_sand_service_extract_client_token():
+    sand = SandService('http://sand-py-test', SAND_TOKEN_PATH, SAND_TOKEN_VERIFY_PATH, 'A', 'B', 'C', 'D', SimpleCache())
+    assert sand._extract_client_token({'Authorization': 'bearer   abc'}) == 'abc'
+    for headers in [{}, {'Authorization': 'Basic abc'}, {'Authorization': 'Bearer '}]:
+        try:
+            sand._extract_client_token(headers)
+        except SandError as e:
+            assert e.code == 401
+        else:
+            assert True is False
+
+###### Test middleware
+# Test that the WSGI middleware maps errors to responses and memoizes the decision per request
+@mock.patch('sand_python.sand_transport.requests.Session.post', side_effect=mocked_requests_response1)
+def test_sand_wsgi_middleware(mock1):
+    sand = SandService('http://sand-py-test', SAND_TOKEN_PATH, SAND_TOKEN_VERIFY_PATH, 'A', 'B', 'C', 'D', SimpleCache())
+    sand.validate_request = mock.Mock(wraps=sand.validate_request)
+    def app(environ, start_response):
+        # A nested check in the app reuses the decision of the middleware
+        if environ['PATH_INFO'] != '/health':
+            assert validate_request_once(sand, environ, {'Authorization': environ['HTTP_AUTHORIZATION']})['allowed'] is True
+        start_response('200 OK', [])
+        return [b'ok']
+    middleware = SandWSGIMiddleware(app, sand, exempt_paths=['/health'])
+    statuses = []
+    start_response = lambda status, headers: statuses.append(status)
+    assert middleware({'PATH_INFO': '/', 'HTTP_AUTHORIZATION': 'Bearer token'}, start_response) == [b'ok']
+    assert sand.validate_request.call_count == 1
+    body = middleware({'PATH_INFO': '/'}, start_response)
+    assert statuses[-1] == '401 Unauthorized' and b'Did not find any authentication token' in body[0]
+    assert middleware({'PATH_INFO': '/health'}, start_response) == [b'ok']
+    with mock.patch('sand_python.sand_transport.requests.Session.post', side_effect=mocked_requests_response2):
+        middleware({'PATH_INFO': '/', 'HTTP_AUTHORIZATION': 'Bearer denied'}, start_response)
+    assert statuses[-1] == '401 Unauthorized'
+
+# Test the ASGI middleware with the async service
+@mock.patch.object(AsyncSandTransport, 'post', side_effect=mocked_async_requests_response1)
+def test_sand_asgi_middleware(mock1):
+    sand = AsyncSandService('http://sand-py-test', SAND_TOKEN_PATH, SAND_TOKEN_VERIFY_PATH, 'A', 'B', 'C', 'D', SimpleCache())
+    async def app(scope, receive, send):
+        decision = await validate_request_once_async(sand, scope, {'Authorization': 'Bearer token'})
+        await send({'type': 'http.response.start', 'status': 200, 'headers': []})
+        await send({'type': 'http.response.body', 'body': decision['sub'].encode('utf-8')})
+    middleware = SandASGIMiddleware(app, sand)
+    async def run(headers):
+        sent = []
+        async def send(message):
+            sent.append(message)
+        await middleware({'type': 'http', 'path': '/', 'headers': headers}, None, send)
+        return sent
+    sent = asyncio.run(run([(b'authorization', b'Bearer token')]))
+    assert sent[0]['status'] == 200 and sent[1]['body'] == b'sand-development'
+    assert mock1.call_count == 2
+    sent = asyncio.run(run([]))
+    assert sent[0]['status'] == 401
+
+# Test streamed request bodies are rewound for a retry, or fail clearly when they can not be
+@mock.patch('sand_python.sand_transport.requests.Session.post', side_effect=mocked_requests_response1)
+def test_sand_request_streamed_body(mock_post):
+    import io
+    sent = []
+    def send(prepared, **kwargs):
+        body = prepared.body
+        sent.append((body.read() if hasattr(body, 'read') else b''.join(body), kwargs.get('stream')))
+        return MockResponse(None, 401)
+    with mock.patch('sand_python.sand_transport.requests.Session.send', side_effect=send):
+        payload = io.BytesIO(b'xxdocument')
+        payload.read(2)
+        resp = SandClient().request('PUT', 'http://some-something/', app_sand_service, request_body=payload, max_retries=3, stream=True)
+        assert resp.status_code == 401
+        assert sent == [(b'document', True)] * 3
+        del sent[:]
+        try:
+            SandClient().request('PUT', 'http://some-something/', app_sand_service, request_body=(c for c in [b'doc', b'ument']), max_retries=3)
+        except SandError as e:
+            assert 'can not be sent again' in e.get()
+        else:
+            assert True is False
+        assert sent == [(b'document', None)] or sent == [(b'document', False)]
+    view = memoryview(b'document')
+    assert RequestBody(view).for_attempt() is view
+
+# Test a service token is fetched and cached per scope set
+def test_sand_service_multi_scope_tokens():
+    def post(url, **kwargs):
+        scope = dict(kwargs['data'])['scope']
+        return MockResponse({"access_token": "token " + scope, "expires_in": 3599, "scope": scope, "token_type": "bearer"}, 200)
+    sent = []
+    def send(prepared, **kwargs):
+        sent.append(prepared.headers['Authorization'])
+        return MockResponse({"success": "some response"}, 200)
+    with mock.patch('sand_python.sand_transport.requests.Session.post', side_effect=post) as mock_post, \
+         mock.patch('sand_python.sand_transport.requests.Session.send', side_effect=send):
+        sand = SandService('http://sand-py-test', SAND_TOKEN_PATH, SAND_TOKEN_VERIFY_PATH, 'A', 'B', 'C', 'own', SimpleCache(),
+                           service_scopes={'billing': 'billing:read billing:write', 'ocr': ['ocr'], 'same': 'own'})
+        tokens = sand.prefetch_tokens()
+        assert tokens == {'own': 'token own', 'billing:read billing:write': 'token billing:read billing:write', 'ocr': 'token ocr'}
+        assert mock_post.call_count == 3
+        assert sand.get_token() == 'token own'
+        assert sand.get_token(['billing:write', 'billing:read']) == 'token billing:read billing:write'
+        SandClient().request('GET', 'http://ocr/', sand, target='ocr')
+        SandClient().request('GET', 'http://other/', sand)
+        assert sent == ['Bearer token ocr', 'Bearer token own']
+        assert mock_post.call_count == 3
+        try:
+            sand.get_token(target='unknown')
+        except SandError as e:
+            assert e.code == 500
+        else:
+            assert True is False
+
+# Test fan-out requests run concurrently, keep their order and stop at the deadline
+@mock.patch('sand_python.sand_transport.requests.Session.post', side_effect=mocked_requests_response1)
+def test_sand_request_many(mock_post):
+    def send(prepared, **kwargs):
+        if prepared.url.endswith('/slow'):
+            time.sleep(0.5)
+        elif prepared.url.endswith('/down'):
+            raise requests.ConnectionError()
+        return MockResponse({"url": prepared.url, "auth": prepared.headers['Authorization']}, 200)
+    sand = SandService('http://sand-py-test', SAND_TOKEN_PATH, SAND_TOKEN_VERIFY_PATH, 'A', 'B', 'C', 'D', SimpleCache())
+    headers = {'X-Correlation-Id': '12345'}
+    with mock.patch('sand_python.sand_transport.requests.Session.send', side_effect=send):
+        start = time.time()
+        results = SandClient().request_many([('GET', 'http://a/fast', None, headers),
+                                             {'method': 'POST', 'request_url': 'http://b/down'},
+                                             ('GET', 'http://c/slow'),
+                                             ('GET', 'http://d/slow')], sand, deadline_secs=5)
+        assert time.time() - start < 1
+        assert results[0].json()['url'] == 'http://a/fast' and results[0].json()['auth'] == 'Bearer some token'
+        assert isinstance(results[1], SandError) and results[1].code == 502
+        assert results[2].json()['url'] == 'http://c/slow' and results[3].status_code == 200
+        assert 'Authorization' not in headers
+        assert mock_post.call_count == 1
+        results = SandClient().request_many([('GET', 'http://a/fast'), ('GET', 'http://c/slow')], sand, deadline_secs=0.1)
+        assert results[0].status_code == 200
+        assert isinstance(results[1], SandError) and results[1].code == 504
+
+# Test the shared cache is seen by forked workers and keeps TTLs
+@mock.patch('sand_python.sand_transport.requests.Session.post', side_effect=mocked_requests_response1)
+def test_shared_cache(mock1):
+    import tempfile
+    path = os.path.join(tempfile.mkdtemp(), 'sand.cache')
+    cache = SharedCache(path, slots=64, slot_size=512)
+    sand = SandService('http://sand-py-test', SAND_TOKEN_PATH, SAND_TOKEN_VERIFY_PATH, 'A', 'B', 'C', 'D', cache, compact_cache_values=True)
+    sand.validate_request(sand_req_from_client.headers)
+    pid = os.fork()
+    if pid == 0:
+        # The child must never return into pytest, whatever happens in it
+        code = 1
+        try:
+            # A worker sharing the file gets the decision and token without calling SAND
+            worker = SandService('http://sand-py-test', SAND_TOKEN_PATH, SAND_TOKEN_VERIFY_PATH, 'A', 'B', 'C', 'D', SharedCache(path, slots=64, slot_size=512), compact_cache_values=True)
+            ok = worker.validate_request(sand_req_from_client.headers)['allowed'] is True and worker.get_token() == 'some token'
+            cache.set('from_worker', ok)
+            code = 0 if ok else 2
+        finally:
+            os._exit(code)
+    assert os.waitpid(pid, 0)[1] == 0
+    assert cache.get('from_worker') is True
+    assert mock1.call_count == 2
+    assert cache.add('lock', 1, 1) is True and cache.add('lock', 2, 1) is False
+    assert cache.set('big', 'x' * 1024) is False and cache.get('big') is None
+    cache.set('short', 'value', 0.2)
+    time.sleep(0.3)
+    assert cache.get('short') is None
+    assert cache.delete('from_worker') is True and cache.get('from_worker') is None
+    # Values are stored as JSON, keeping tuples apart from lists
+    cache.set('decision', (True, 'sub', ['a', 'b'], {'n': (1, None)}))
+    assert cache.get('decision') == (True, 'sub', ['a', 'b'], {'n': (1, None)})
+    # Files other users could write to, and symlinks, are refused
+    os.chmod(path, 0o660)
+    try:
+        SharedCache(path, slots=64, slot_size=512)
+    except SandError as e:
+        assert e.code == 500
+    else:
+        assert True is False
+    os.chmod(path, 0o600)
+    link = path + '.link'
+    os.symlink(path, link)
+    try:
+        SharedCache(link, slots=64, slot_size=512)
+    except OSError:
+        pass
+    else:
+        assert True is False
+
+# Test warm_up fetches the tokens and opens the connections the first requests reuse
+@mock.patch('sand_python.sand_transport.requests.Session.post', side_effect=mocked_requests_response1)
+def test_sand_warm_up(mock_post):
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    connections = []
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        def setup(self):
+            connections.append(self.client_address)
+            BaseHTTPRequestHandler.setup(self)
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        do_HEAD = do_GET
+        def log_message(self, *args):
+            pass
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    server.timeout = 5
+    serving = threading.Thread(target=server.handle_request)
+    serving.daemon = True
+    serving.start()
+    try:
+        url = 'http://127.0.0.1:' + str(server.server_port) + '/'
+        sand = SandService('http://sand-py-test', SAND_TOKEN_PATH, SAND_TOKEN_VERIFY_PATH, 'A', 'B', 'C', 'D', SimpleCache(), service_scopes={'billing': 'billing'})
+        assert sand.readiness() == {'ready': False, 'tokens': {'D': False, 'billing': False}, 'circuits': {'token': 'closed', 'verify': 'closed'}}
+        report = SandClient().warm_up(sand, [url, 'http://127.0.0.1:1/'], timeout=1)
+        assert report['tokens'] == {'D': True, 'billing': True}
+        assert report['connections'][url] is True and report['ready'] is False
+        assert not isinstance(report['connections']['http://127.0.0.1:1/'], bool)
+        assert sand.is_ready() is True
+        assert sand.transport.session.get(url, timeout=5).status_code == 200
+        assert len(connections) == 1
+    finally:
+        server.server_close()
+
+# Test cache TTLs count from the local receive time, keep a margin, are capped and follow SAND's clock
+def test_sand_service_cache_ttl_alignment():
+    from email.utils import formatdate
+    sand = SandService('http://sand-py-test', SAND_TOKEN_PATH, SAND_TOKEN_VERIFY_PATH, 'A', 'B', 'C', 'D', SimpleCache(), cache_ttl_margin_secs=5, max_cache_ttl_secs=600)
+    now = float(int(time.time()))
+    def rfc3339(t):
+        return datetime.utcfromtimestamp(t).strftime("%Y-%m-%dT%H:%M:%SZ")
+    # A token verified near the end of its hour long life is cached only until its exp
+    assert sand._get_cache_expiry_secs({'allowed': True, 'iat': rfc3339(now - 3500), 'exp': rfc3339(now + 100)}, now) == 95
+    assert sand._get_cache_expiry_secs({'allowed': True, 'iat': rfc3339(now), 'exp': rfc3339(now + 3600)}, now) == 600
+    assert sand._get_cache_expiry_secs({'allowed': True, 'iat': rfc3339(now - 3600), 'exp': rfc3339(now)}, now) == 0
+    assert sand._get_token_cache_secs({'expires_in': 60}, time.time() - 2) == 53
+    def post(url, **kwargs):
+        resp = MockHeadersResponse({"access_token": "some token", "expires_in": 3599, "scope": "sand_scope", "token_type": "bearer"}, 200,
+                                   {'Date': formatdate(time.time() + 120, usegmt=True)})
+        return resp
+    sand = SandService('http://sand-py-test', SAND_TOKEN_PATH, SAND_TOKEN_VERIFY_PATH, 'A', 'B', 'C', 'D', SimpleCache(), detect_clock_skew=True)
+    with mock.patch('sand_python.sand_transport.requests.Session.post', side_effect=post):
+        sand.get_token()
+    assert 118 <= sand.clock_skew <= 121
+    # SAND's clock is two minutes ahead, so a token with 100s left by its clock is not kept for 220s
+    assert 98 <= sand._get_cache_expiry_secs({'allowed': True, 'iat': rfc3339(now - 3380), 'exp': rfc3339(now + 220)}, now) <= 102
+
+# Test spans for the cache, SAND calls, attempts and retry waits, and trace context sent downstream
+@mock.patch('sand_python.sand_transport.requests.Session.post', side_effect=mocked_requests_response1)
+@mock.patch('sand_python.sand_client.time.sleep')
+def test_sand_tracing(mock_sleep, mock_post):
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+    from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+    from .sand_tracing import OpenTelemetryTracer
+    exporter = InMemorySpanExporter()
+    provider = TracerProvider()
+    provider.add_span_processor(SimpleSpanProcessor(exporter))
+    sand = SandService('http://sand-py-test', SAND_TOKEN_PATH, SAND_TOKEN_VERIFY_PATH, 'A', 'B', 'C', 'D', SimpleCache(), tracer=OpenTelemetryTracer(provider))
+    sand.validate_request(sand_req_from_client.headers)
+    sand.validate_request(sand_req_from_client.headers)
+    spans = [(span.name, dict(span.attributes)) for span in exporter.get_finished_spans()]
+    assert spans == [('sand.cache_get', {'sand.cache.kind': 'client_token', 'sand.cache.hit': False}),
+                     ('sand.cache_get', {'sand.cache.kind': 'service_token', 'sand.cache.hit': False}),
+                     ('sand.token_fetch', {'http.status_code': 200}),
+                     ('sand.token_verify', {'http.status_code': 200}),
+                     ('sand.cache_get', {'sand.cache.kind': 'client_token', 'sand.cache.hit': True})]
+    exporter.clear()
+    sent = []
+    def send(prepared, **kwargs):
+        sent.append(prepared.headers.get('traceparent'))
+        return MockHeadersResponse(None, 503 if len(sent) == 1 else 200, {'Retry-After': '1'})
+    with mock.patch('sand_python.sand_transport.requests.Session.send', side_effect=send):
+        SandClient().request('GET', 'http://some-something/', sand, max_retries=2)
+    spans = exporter.get_finished_spans()
+    attempts = [span for span in spans if span.name == 'sand.client_request']
+    assert [(span.attributes['sand.attempt'], span.attributes['http.status_code']) for span in attempts] == [(1, 503), (2, 200)]
+    assert [dict(span.attributes) for span in spans if span.name == 'sand.client_retry_wait'] == [{'sand.retry.reason': 'status', 'sand.retry.wait': 1.0}]
+    # Each attempt is the parent of the downstream request
+    assert [header.split('-')[1:3] for header in sent] == [['%032x' % span.context.trace_id, '%016x' % span.context.span_id] for span in attempts]
+    assert SandTracer().span('cache_get') is SandTracer().span('token_fetch')
@@ -31,12 +31,20 @@ setup(
         'Intended Audience :: Developers',
         'License :: OSI Approved :: BSD License',
         'Operating System :: OS Independent',
-        'Programming Language :: Python :: 2.7',
+        'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3 :: Only',
         'Topic :: Software Development :: Libraries :: Python Modules',
     ],
     keywords='sand',
+    python_requires='>=3.7',
     install_requires=[
         'requests>=2.24.0',
         'python-dateutil>=2.7.5'
-    ]
+    ],
+    extras_require={
+        'async': ['aiohttp>=3.7'],
+        'jwt': ['PyJWT[crypto]>=2.0'],
+        'prometheus': ['prometheus_client'],
+        'tracing': ['opentelemetry-api'],
+    }
 )